@@ -6,24 +6,41 @@ The init module creates Flask object and log handler
 import logging
 from flask import Flask
 from flask_restful import Api
-from app.secrets import Secrets
+from app.secrets import Secrets, SecretsBatch, SecretsUndelete
 from app.app_secrets import AppSecrets
-from app.node_certs import NodeCerts
+from app.node_certs import (NodeCerts, NodeCertsBatch, NodeCertsSign, NodeCertsRevoke, NodeCertsExpiring,
+                            NodeCertsRenewed)
 from app.node_crl import NodeCrl
 from app.join_tokens import JoinTokens
 from app.crypto_engine import CryptoEngine
 from app.image_verify import ImageVerify
+from app.status import Status
+from app.readiness import Readiness
+from app.metrics import Metrics
+from lib import metrics
 
 
 app = Flask(__name__)
 
 app.logger.setLevel(logging.INFO)
 
+metrics.init_app(app)
+
 api = Api(app)
 api.add_resource(Secrets, '/v1.0/secrets', '/v1.0/secrets/<secret_name>')
+api.add_resource(SecretsBatch, '/v1.0/secrets:batch')
+api.add_resource(SecretsUndelete, '/v1.0/secrets/<secret_name>:undelete')
 api.add_resource(AppSecrets, '/v1.0/appsecrets', '/v1.0/appsecrets/<secret_name>')
 api.add_resource(NodeCerts, '/v1.0/nodecerts', '/v1.0/nodecerts/<serial>')
+api.add_resource(NodeCertsBatch, '/v1.0/nodecerts:batch')
+api.add_resource(NodeCertsSign, '/v1.0/nodecerts/sign')
+api.add_resource(NodeCertsRevoke, '/v1.0/nodecerts:revoke')
+api.add_resource(NodeCertsExpiring, '/v1.0/nodecerts:expiring')
+api.add_resource(NodeCertsRenewed, '/v1.0/nodecerts/<serial>:renewed')
 api.add_resource(NodeCrl, '/v1.0/nodecrl')
 api.add_resource(JoinTokens, '/v1.0/jointokens', '/v1.0/jointokens/<token>')
 api.add_resource(CryptoEngine, '/v1.0/cryptoengine/<path:path>')
 api.add_resource(ImageVerify, '/v1.0/imageverify')
+api.add_resource(Status, '/v1.0/status')
+api.add_resource(Readiness, '/v1.0/ready')
+api.add_resource(Metrics, '/metrics')
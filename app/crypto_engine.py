@@ -2,37 +2,40 @@ import logging
 from flask import request
 from flask import Response
 from flask_restful import Resource
-import requests
 import requests.exceptions
+from lib.resilience import CircuitBreakerOpenError
+from lib.upstream_proxy import UpstreamProxy, UpstreamBusyError
 
 
 CRYPTO_ENGINE_URL = "http://crypto_engine:5000"
 
 
 class CryptoEngine(Resource):
+    _proxy = UpstreamProxy('crypto_engine', CRYPTO_ENGINE_URL + '/api/v1.0/')
+
     def __init__(self):
         self._logger = logging.getLogger('flask.app')
 
     def get(self, path):
         self._logger.info('Crypto Engine endpoint method GET path %s from %s', path, request.remote_addr)
 
-        try:
-            resp = requests.post(CRYPTO_ENGINE_URL + '/api/v1.0/' + path)
-        except requests.exceptions.RequestException as error:
-            self._logger.error('Crypto Engine unreachable.')
-            self._logger.info(error)
-            return Response('Crypto Engine unreachable.', 500)
-
-        return Response(resp.content, resp.status_code)
+        return self._forward(path)
 
     def post(self, path):
         self._logger.info('Crypto Engine endpoint method POST path %s from %s', path, request.remote_addr)
 
+        return self._forward(path, request)
+
+    def _forward(self, path, incoming=None):
         try:
-            resp = requests.post(CRYPTO_ENGINE_URL + '/api/v1.0/' + path, data=request.get_data())
+            return self._proxy.forward('POST', path, incoming)
+        except UpstreamBusyError:
+            self._logger.error('Crypto Engine busy.')
+            return Response('Crypto Engine busy.', 503)
+        except CircuitBreakerOpenError:
+            self._logger.error('Crypto Engine unavailable.')
+            return Response('Crypto Engine unavailable.', 503)
         except requests.exceptions.RequestException as error:
             self._logger.error('Crypto Engine unreachable.')
             self._logger.info(error)
             return Response('Crypto Engine unreachable.', 500)
-
-        return Response(resp.content, resp.status_code)
@@ -2,14 +2,17 @@ import logging
 from flask import request
 from flask import Response
 from flask_restful import Resource
-import requests
 import requests.exceptions
+from lib.resilience import CircuitBreakerOpenError
+from lib.upstream_proxy import UpstreamProxy, UpstreamBusyError
 
 
 IMAGE_VERIFIER_URL = "http://iivr:5000"
 
 
 class ImageVerify(Resource):
+    _proxy = UpstreamProxy('iivr', IMAGE_VERIFIER_URL + '/api/v1.0/')
+
     def __init__(self):
         self._logger = logging.getLogger('flask.app')
 
@@ -17,10 +20,14 @@ class ImageVerify(Resource):
         self._logger.info('Image Verify endpoint method POST from %s', request.remote_addr)
 
         try:
-            resp = requests.post(IMAGE_VERIFIER_URL + '/api/v1.0/image_verify', data=request.get_data())
+            return self._proxy.forward('POST', 'image_verify', request)
+        except UpstreamBusyError:
+            self._logger.error('Image Verifier busy.')
+            return Response('Image Verifier busy.', 503)
+        except CircuitBreakerOpenError:
+            self._logger.error('Image Verifier unavailable.')
+            return Response('Image Verifier unavailable.', 503)
         except requests.exceptions.RequestException as error:
             self._logger.error('Image Verifier unreachable.')
             self._logger.info(error)
             return Response('Image Verifier unreachable.', 500)
-
-        return Response(resp.content, resp.status_code)
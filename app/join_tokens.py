@@ -1,8 +1,8 @@
 import logging
-import subprocess
 from flask import request
 from flask import Response
 from flask_restful import Resource
+from lib.join_token_backend import JoinTokenBackend, JoinTokenNotFoundError, JOIN_TOKEN_BATCH_MAX
 
 
 class JoinTokens(Resource):
@@ -14,17 +14,28 @@ class JoinTokens(Resource):
         Register a new worker node in Kubernetes.
         [description]
         A new join token is generated for the client and is returned along with the private key.
+        With ?count=N, N join commands are returned, one per line.
         '''
         self._logger.info('Join Tokens endpoint method POST from %s', request.remote_addr)
 
+        count = request.args.get('count', 1)
+
+        try:
+            count = int(count)
+        except ValueError:
+            count = 0
+
+        if not 1 <= count <= JOIN_TOKEN_BATCH_MAX:
+            return Response('The count must be between 1 and %d.' % JOIN_TOKEN_BATCH_MAX, 400)
+
         try:
-            res = subprocess.run(['kubeadm', 'token', 'create', '--print-join-command'], capture_output=True)
+            join_commands = JoinTokenBackend().take_tokens(count)
         except Exception as error:
-            self._logger.error('Unable to call kubeadm.')
+            self._logger.error('Unable to generate Kubernetes token.')
             self._logger.info(error)
             return Response('Unable to generate Kubernetes token.', 500)
 
-        return Response(res.stdout, 201)
+        return Response(''.join(join_commands), 201)
 
     def delete(self, token):
         '''[summary]
@@ -38,10 +49,12 @@ class JoinTokens(Resource):
         self._logger.info('Join Tokens endpoint method DELETE token %s from %s', token, request.remote_addr)
 
         try:
-            res = subprocess.run(['kubeadm', 'token', 'delete', token], capture_output=True)
+            res = JoinTokenBackend().delete_token(token)
+        except JoinTokenNotFoundError:
+            return Response('Kubernetes token not found.', 404)
         except Exception as error:
-            self._logger.error('Unable to call kubeadm.')
+            self._logger.error('Unable to delete Kubernetes token.')
             self._logger.info(error)
             return Response('Unable to delete Kubernetes token.', 500)
 
-        return Response(res.stdout, 200)
+        return Response(res, 200)
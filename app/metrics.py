@@ -0,0 +1,17 @@
+from flask import Response
+from flask_restful import Resource
+from prometheus_client import CONTENT_TYPE_LATEST
+from lib.metrics import export
+
+
+class Metrics(Resource):
+    def get(self):
+        '''[summary]
+        Export metrics for Prometheus
+        [description]
+
+        Returns:
+            [type] text -- [description] request counts and latencies per endpoint and
+            latencies of the calls to Vault, Kubernetes, kubeadm and the upstreams
+        '''
+        return Response(export(), 200, content_type=CONTENT_TYPE_LATEST)
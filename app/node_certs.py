@@ -1,17 +1,108 @@
+import datetime
 import logging
 import json
+import re
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import request, Response
 from flask_restful import Resource
 from requests import exceptions
-from lib.vault_backend import VaultPkiBackend
+from lib import cert_pool, der
+from lib.cert_index import (CertificateIndex, CertificateIndexReconcilingError, CERT_INDEX_PAGE_SIZE,
+                            CERT_INDEX_PAGE_MAX)
+from lib.cert_pool import CertificatePool
+from lib.cert_renewal import CertificateRenewal, CERT_RENEWAL_WINDOW
+from lib.pki_cache import PkiCache
+from lib.resilience import CircuitBreakerOpenError
+from lib.vault_backend import VaultPkiBackend, VAULT_PKI_DOMAINS
 from lib.json_response import JsonResponse
 
 
+# Maximum number of certificates issued concurrently for batch requests
+NODE_CERTS_BATCH_CONCURRENCY = 8
+
+# Maximum number of certificates in one batch request
+NODE_CERTS_BATCH_MAX = 500
+
+# Maximum number of certificates revoked concurrently for bulk revocations
+NODE_CERTS_REVOKE_CONCURRENCY = 8
+
+# Maximum number of certificates in one bulk revocation
+NODE_CERTS_REVOKE_MAX = 1000
+
+# Query parameters that select the filtered listing from the certificate index
+NODE_CERTS_LIST_PARAMS = ('common_name', 'expires_within', 'revoked', 'offset', 'limit')
+
+# Host name label allowed in the common name of a certificate signing request
+NODE_CERTS_SIGN_LABEL = re.compile(r'^[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?$', re.IGNORECASE)
+
+
+def _random_common_name():
+    return uuid.uuid4().hex + '.workernode.micado'
+
+
+def _issue_certificate(vault_backend, cert_common_name):
+    params = {
+        'common_name': cert_common_name,
+        'format': 'pem_bundle'
+    }
+
+    return vault_backend.post('/v1/pki/issue/micado', params)
+
+
+def _sign_certificate(vault_backend, csr, cert_common_name):
+    params = {
+        'csr': csr,
+        'common_name': cert_common_name,
+        'format': 'pem_bundle'
+    }
+
+    return vault_backend.post('/v1/pki/sign/micado', params)
+
+
+def _csr_common_name(csr):
+    '''[summary]
+    Validate a certificate signing request against the PKI role micado
+    [description]
+    Checked locally, so requests Vault would refuse cost no call: the common name must be
+    a subdomain of one of the role's domains, which do not allow bare domains or wildcards.
+
+    Returns:
+        [type] string -- [description] the common name, None if the request is invalid
+    '''
+    if not isinstance(csr, str):
+        return None
+
+    try:
+        common_name = der.csr_info(der.pem_to_der(csr, 'CERTIFICATE REQUEST'))['common_name']
+    except der.DerError:
+        return None
+
+    if not common_name or len(common_name) > 253:
+        return None
+
+    for domain in VAULT_PKI_DOMAINS:
+        subdomain, dot, parent = common_name.lower().rpartition('.' + domain)
+
+        if subdomain and not parent and all(NODE_CERTS_SIGN_LABEL.match(label) for label in subdomain.split('.')):
+            return common_name
+
+    return None
+
+
+def _revoke_certificate(vault_backend, serial):
+    params = {
+        'serial_number': serial
+    }
+
+    return vault_backend.post('/v1/pki/revoke', params)
+
+
 class NodeCerts(Resource):
     def __init__(self):
         self._logger = logging.getLogger('flask.app')
         self._vault_backend = VaultPkiBackend()
+        self._pki_cache = PkiCache()
 
     def post(self):
         '''[summary]
@@ -21,17 +112,19 @@ class NodeCerts(Resource):
         '''
         self._logger.info('Node Certs endpoint method POST from %s', request.remote_addr)
 
-        cert_common_name = uuid.uuid4().hex + '.workernode.micado'
+        if 'cert_common_name' not in request.form and cert_pool.CERT_POOL_ENABLED:
+            pooled = CertificatePool().take()
+            if pooled is not None:
+                return Response(pooled['certificate'], 200)
+
+        cert_common_name = _random_common_name()
         if 'cert_common_name' in request.form:
             cert_common_name = request.form["cert_common_name"]
 
-        params = {
-            'common_name': cert_common_name,
-            'format': 'pem_bundle'
-        }
-
         try:
-            cert = self._vault_backend.post('/v1/pki/issue/micado', params)
+            cert = _issue_certificate(self._vault_backend, cert_common_name)
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except exceptions.RequestException as error:
             self._logger.error('Unable to generate certificate in Vault PKI.')
             self._logger.info(error)
@@ -44,6 +137,8 @@ class NodeCerts(Resource):
 
             self._logger.info('Generated certificate with serial %s', data['data']['serial_number'])
 
+            CertificateIndex().add(data['data']['serial_number'], data['data']['certificate'])
+
             return Response(data['data']['certificate'], 200)
 
     def get(self, serial=None):
@@ -65,9 +160,13 @@ class NodeCerts(Resource):
 
         try:
             if serial == 'ca':
-                cert = self._vault_backend.getAnonymous('/v1/pki/ca/pem')
+                ca, cert = self._pki_cache.get('ca')
+                if ca is not None:
+                    return ca.response()
             else:
                 cert = self._vault_backend.getAnonymous('/v1/pki/cert/' + serial)
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except exceptions.RequestException as error:
             self._logger.error('Unable to get certificate from Vault.')
             self._logger.info(error)
@@ -80,8 +179,13 @@ class NodeCerts(Resource):
             return Response(data['data']['certificate'], 200)
 
     def _list(self):
+        if any(param in request.args for param in NODE_CERTS_LIST_PARAMS):
+            return self._query()
+
         try:
             certlist = self._vault_backend.list('/v1/pki/certs')
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except exceptions.RequestException as error:
             self._logger.error('Unable to list certificates in Vault PKI.')
             self._logger.info(error)
@@ -93,6 +197,51 @@ class NodeCerts(Resource):
             data = json.loads(certlist.text)
             return Response('\n'.join(data['data']['keys']), 200)
 
+    def _query(self):
+        '''[summary]
+        List certificates from the index, filtered and paginated
+        [description]
+        Query parameters:
+            common_name -- shell-style pattern, e.g. *.workernode.micado
+            expires_within -- seconds, only certificates expiring within this time
+            revoked -- true or false
+            offset, limit -- page of the matching certificates, ordered by serial
+
+        Returns:
+            [type] json -- [description] total number of matches and serial_number, common_name,
+            not_before, not_after and revoked of the certificates in the page
+        '''
+        args = request.args
+
+        try:
+            expires_before = None
+            if 'expires_within' in args:
+                expires_before = (datetime.datetime.now(datetime.timezone.utc)
+                                  + datetime.timedelta(seconds=int(args['expires_within'])))
+
+            revoked = None
+            if 'revoked' in args:
+                revoked = {'true': True, 'false': False}[args['revoked'].lower()]
+
+            offset = int(args.get('offset', 0))
+            limit = int(args.get('limit', CERT_INDEX_PAGE_SIZE))
+        except (KeyError, ValueError):
+            return JsonResponse.create(JsonResponse.LIST_BAD_REQUEST)
+
+        if offset < 0 or not 1 <= limit <= CERT_INDEX_PAGE_MAX:
+            return JsonResponse.create(JsonResponse.LIST_BAD_REQUEST)
+
+        try:
+            page = CertificateIndex().query(args.get('common_name'), expires_before, revoked, offset, limit)
+        except CertificateIndexReconcilingError:
+            return JsonResponse.create(JsonResponse.CERT_INDEX_RECONCILING)
+        except Exception as error:
+            self._logger.error('Unable to list certificates in Vault PKI.')
+            self._logger.info(error)
+            return JsonResponse.create(JsonResponse.READ_SECRET_FAIL)
+
+        return page
+
     def delete(self, serial=None):
         '''[summary]
         Revoke a certificate.
@@ -107,12 +256,10 @@ class NodeCerts(Resource):
         if not serial:
             return JsonResponse.create(JsonResponse.DELETE_SECRET_BAD_REQUEST)
 
-        params = {
-            'serial_number': serial
-        }
-
         try:
-            resp = self._vault_backend.post('/v1/pki/revoke', params)
+            resp = _revoke_certificate(self._vault_backend, serial)
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except exceptions.RequestException as error:
             self._logger.error('Unable to revoke certificate in Vault PKI.')
             self._logger.info(error)
@@ -121,5 +268,393 @@ class NodeCerts(Resource):
         if resp.status_code != 200:
             return Response(resp.text, resp.status_code)
         else:
+            self._pki_cache.invalidate('crl')
+            CertificateIndex().revoke(serial)
+
             data = json.loads(resp.text)
             return Response(json.dumps(data['data']), 200)
+
+
+class NodeCertsBatch(Resource):
+    # shared by all requests of the worker, bounds the load put on Vault
+    _executor = ThreadPoolExecutor(max_workers=NODE_CERTS_BATCH_CONCURRENCY, thread_name_prefix='nodecerts-batch')
+
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+        self._vault_backend = VaultPkiBackend()
+
+    def post(self):
+        '''[summary]
+        Register many worker nodes in the Vault PKI.
+        [description]
+        Certificates are issued concurrently and streamed back as newline delimited json,
+        one object per certificate in the order they are issued.
+
+        Arguments:
+            count -- number of certificates with random common names
+            common_names -- list of common names, instead of count
+
+        Returns:
+            [type] ndjson -- [description] common_name, code and either serial_number and
+            certificate (pem bundle with private key) or error, for every certificate
+        '''
+        json_body = request.get_json(silent=True)
+
+        if json_body is not None and not isinstance(json_body, dict):
+            return JsonResponse.create(JsonResponse.NODE_CERTS_BATCH_BAD_REQUEST)
+
+        body = json_body or request.form
+
+        common_names = body.get('common_names')
+        count = body.get('count')
+
+        if common_names is not None:
+            if not isinstance(common_names, list) or not all(isinstance(common_name, str) and common_name
+                                                             for common_name in common_names):
+                common_names = None
+        elif count is not None and not isinstance(count, bool):
+            try:
+                count = int(count)
+            except (TypeError, ValueError):
+                count = 0
+
+            # random common names, taken from the certificate pool when possible
+            if 0 < count <= NODE_CERTS_BATCH_MAX:
+                common_names = [None] * count
+
+        self._logger.info('Node Certs endpoint method POST batch of %s from %s',
+                          len(common_names) if common_names else 0, request.remote_addr)
+
+        if not common_names or len(common_names) > NODE_CERTS_BATCH_MAX:
+            return JsonResponse.create(JsonResponse.NODE_CERTS_BATCH_BAD_REQUEST)
+
+        futures = {self._executor.submit(self._issue, common_name): common_name for common_name in common_names}
+
+        return Response(self._stream(futures), 200, mimetype='application/x-ndjson')
+
+    def _issue(self, cert_common_name):
+        if cert_common_name is None:
+            if cert_pool.CERT_POOL_ENABLED:
+                pooled = CertificatePool().take()
+                if pooled is not None:
+                    return {
+                        'common_name': pooled['common_name'],
+                        'code': 200,
+                        'serial_number': pooled['serial_number'],
+                        'certificate': pooled['certificate']
+                    }
+
+            cert_common_name = _random_common_name()
+
+        try:
+            cert = _issue_certificate(self._vault_backend, cert_common_name)
+        except CircuitBreakerOpenError:
+            return {'common_name': cert_common_name, 'code': 503,
+                    'error': JsonResponse.body(JsonResponse.VAULT_UNAVAILABLE)['message']}
+        except exceptions.RequestException as error:
+            self._logger.error('Unable to generate certificate in Vault PKI.')
+            self._logger.info(error)
+            return {'common_name': cert_common_name, 'code': 500, 'error': 'Unable to generate certificate.'}
+
+        if cert.status_code != 200:
+            return {'common_name': cert_common_name, 'code': cert.status_code, 'error': cert.text}
+
+        data = json.loads(cert.text)
+
+        self._logger.info('Generated certificate with serial %s', data['data']['serial_number'])
+
+        CertificateIndex().add(data['data']['serial_number'], data['data']['certificate'])
+
+        return {
+            'common_name': cert_common_name,
+            'code': 200,
+            'serial_number': data['data']['serial_number'],
+            'certificate': data['data']['certificate']
+        }
+
+    @staticmethod
+    def _stream(futures):
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + '\n'
+        finally:
+            # the client went away, do not issue certificates nobody will receive
+            for future in futures:
+                future.cancel()
+
+
+class NodeCertsSign(Resource):
+    # shared by all requests of the worker, bounds the load put on Vault
+    _executor = ThreadPoolExecutor(max_workers=NODE_CERTS_BATCH_CONCURRENCY, thread_name_prefix='nodecerts-sign')
+
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+        self._vault_backend = VaultPkiBackend()
+
+    def post(self):
+        '''[summary]
+        Register worker nodes in the Vault PKI with their own key pairs.
+        [description]
+        The nodes generate their private keys and send certificate signing requests, which
+        Vault signs; private keys never leave the nodes. The common name of each request must
+        be a subdomain of micado. A batch of requests is signed concurrently and the results
+        are streamed back as newline delimited json, in the order they are signed.
+
+        Arguments:
+            csr -- pem certificate signing request, as form field, json or the request body
+            csrs -- list of pem certificate signing requests, instead of csr
+
+        Returns:
+            [type] string -- [description] the certificate followed by the issuing CA, for csr
+            [type] ndjson -- [description] index in csrs, common_name, code and either
+            serial_number and certificate or error, for every request in csrs
+        '''
+        json_body = request.get_json(silent=True)
+        body = json_body if isinstance(json_body, dict) else request.form
+
+        csrs = body.get('csrs')
+
+        if csrs is not None:
+            self._logger.info('Node Certs endpoint method POST sign batch of %s from %s',
+                              len(csrs) if isinstance(csrs, list) else 0, request.remote_addr)
+
+            if not isinstance(csrs, list) or not csrs or len(csrs) > NODE_CERTS_BATCH_MAX:
+                return JsonResponse.create(JsonResponse.SIGN_CSR_BAD_REQUEST)
+
+            futures = {self._executor.submit(self._sign, index, csr): index for index, csr in enumerate(csrs)}
+
+            return Response(NodeCertsBatch._stream(futures), 200, mimetype='application/x-ndjson')
+
+        self._logger.info('Node Certs endpoint method POST sign from %s', request.remote_addr)
+
+        csr = body.get('csr')
+        if csr is None and json_body is None and not request.form:
+            # a bare pem body, e.g. curl --data-binary @node.csr
+            csr = request.get_data(as_text=True)
+
+        cert_common_name = _csr_common_name(csr)
+        if cert_common_name is None:
+            return JsonResponse.create(JsonResponse.SIGN_CSR_BAD_REQUEST)
+
+        try:
+            cert = _sign_certificate(self._vault_backend, csr, cert_common_name)
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
+        except exceptions.RequestException as error:
+            self._logger.error('Unable to sign certificate in Vault PKI.')
+            self._logger.info(error)
+            return JsonResponse.create(JsonResponse.SIGN_CSR_FAIL)
+
+        if cert.status_code != 200:
+            return Response(cert.text, cert.status_code)
+
+        data = json.loads(cert.text)
+
+        self._logger.info('Signed certificate with serial %s', data['data']['serial_number'])
+
+        CertificateIndex().add(data['data']['serial_number'], data['data']['certificate'])
+
+        return Response(data['data']['certificate'], 200)
+
+    def _sign(self, index, csr):
+        cert_common_name = _csr_common_name(csr)
+        if cert_common_name is None:
+            return {'index': index, 'common_name': None, 'code': 400,
+                    'error': JsonResponse.body(JsonResponse.SIGN_CSR_BAD_REQUEST)['message']}
+
+        try:
+            cert = _sign_certificate(self._vault_backend, csr, cert_common_name)
+        except CircuitBreakerOpenError:
+            return {'index': index, 'common_name': cert_common_name, 'code': 503,
+                    'error': JsonResponse.body(JsonResponse.VAULT_UNAVAILABLE)['message']}
+        except exceptions.RequestException as error:
+            self._logger.error('Unable to sign certificate in Vault PKI.')
+            self._logger.info(error)
+            return {'index': index, 'common_name': cert_common_name, 'code': 500,
+                    'error': JsonResponse.body(JsonResponse.SIGN_CSR_FAIL)['message']}
+
+        if cert.status_code != 200:
+            return {'index': index, 'common_name': cert_common_name, 'code': cert.status_code, 'error': cert.text}
+
+        data = json.loads(cert.text)
+
+        self._logger.info('Signed certificate with serial %s', data['data']['serial_number'])
+
+        CertificateIndex().add(data['data']['serial_number'], data['data']['certificate'])
+
+        return {
+            'index': index,
+            'common_name': cert_common_name,
+            'code': 200,
+            'serial_number': data['data']['serial_number'],
+            'certificate': data['data']['certificate']
+        }
+
+
+class NodeCertsRevoke(Resource):
+    # shared by all requests of the worker, bounds the load put on Vault
+    _executor = ThreadPoolExecutor(max_workers=NODE_CERTS_REVOKE_CONCURRENCY, thread_name_prefix='nodecerts-revoke')
+
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+        self._vault_backend = VaultPkiBackend()
+        self._pki_cache = PkiCache()
+
+    def post(self):
+        '''[summary]
+        Revoke many certificates.
+        [description]
+        The certificates are revoked concurrently, then the CRL is rotated once and the
+        cached CRL is refreshed once.
+
+        Arguments:
+            serials -- list of certificate serials
+            common_name -- shell-style pattern, instead of serials, e.g. *.workernode.micado;
+                           every valid certificate in the index with a matching common name is revoked
+
+        Returns:
+            [type] json -- [description] serial_number, code and either revocation_time or error
+            for every certificate, and whether the CRL was rotated
+        '''
+        json_body = request.get_json(silent=True)
+
+        if json_body is not None and not isinstance(json_body, dict):
+            return JsonResponse.create(JsonResponse.NODE_CERTS_REVOKE_BAD_REQUEST, {'max': NODE_CERTS_REVOKE_MAX})
+
+        body = json_body or request.form
+
+        serials = body.get('serials')
+        common_name = body.get('common_name')
+
+        if serials is not None:
+            if not isinstance(serials, list) or not all(isinstance(serial, str) and serial for serial in serials):
+                serials = None
+        elif isinstance(common_name, str) and common_name:
+            try:
+                page = CertificateIndex().query(common_name, revoked=False, limit=NODE_CERTS_REVOKE_MAX + 1)
+            except CertificateIndexReconcilingError:
+                return JsonResponse.create(JsonResponse.CERT_INDEX_RECONCILING)
+            except Exception as error:
+                self._logger.error('Unable to list certificates in Vault PKI.')
+                self._logger.info(error)
+                return JsonResponse.create(JsonResponse.NODE_CERTS_REVOKE_FAIL)
+
+            serials = [cert['serial_number'] for cert in page['certificates']]
+
+        self._logger.info('Node Certs endpoint method POST revocation of %s from %s',
+                          len(serials) if serials is not None else 0, request.remote_addr)
+
+        if serials is None or len(serials) > NODE_CERTS_REVOKE_MAX:
+            return JsonResponse.create(JsonResponse.NODE_CERTS_REVOKE_BAD_REQUEST, {'max': NODE_CERTS_REVOKE_MAX})
+
+        results = list(self._executor.map(self._revoke, serials))
+
+        rotated = False
+
+        if any(result['code'] == 200 for result in results):
+            try:
+                rotated = self._vault_backend.get('/v1/pki/crl/rotate').status_code == 200
+            except (exceptions.RequestException, CircuitBreakerOpenError) as error:
+                self._logger.info(error)
+
+            if not rotated:
+                self._logger.error('Unable to rotate CRL in Vault PKI.')
+
+            self._pki_cache.invalidate('crl')
+
+            try:
+                self._pki_cache.get('crl')
+            except (exceptions.RequestException, CircuitBreakerOpenError) as error:
+                self._logger.info(error)
+
+        return {'results': results, 'crl_rotated': rotated}
+
+    def _revoke(self, serial):
+        try:
+            resp = _revoke_certificate(self._vault_backend, serial)
+        except CircuitBreakerOpenError:
+            return {'serial_number': serial, 'code': 503,
+                    'error': JsonResponse.body(JsonResponse.VAULT_UNAVAILABLE)['message']}
+        except exceptions.RequestException as error:
+            self._logger.error('Unable to revoke certificate in Vault PKI.')
+            self._logger.info(error)
+            return {'serial_number': serial, 'code': 500, 'error': 'Unable to revoke certificate.'}
+
+        if resp.status_code != 200:
+            return {'serial_number': serial, 'code': resp.status_code, 'error': resp.text}
+
+        CertificateIndex().revoke(serial)
+
+        return {
+            'serial_number': serial,
+            'code': 200,
+            'revocation_time': json.loads(resp.text)['data'].get('revocation_time')
+        }
+
+
+class NodeCertsExpiring(Resource):
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+
+    def get(self):
+        '''[summary]
+        List the certificates expiring soonest.
+        [description]
+        Query parameters:
+            within -- seconds from now, defaults to the renewal window
+            limit -- maximum number of certificates
+
+        Returns:
+            [type] json -- [description] serial_number, common_name, not_after and whether a renewed
+            certificate is available, ordered by not_after
+        '''
+        self._logger.info('Node Certs endpoint method GET expiring from %s', request.remote_addr)
+
+        try:
+            within = int(request.args.get('within', CERT_RENEWAL_WINDOW))
+            limit = int(request.args.get('limit', CERT_INDEX_PAGE_MAX))
+        except ValueError:
+            return JsonResponse.create(JsonResponse.LIST_BAD_REQUEST)
+
+        if within < 0 or not 1 <= limit <= CERT_INDEX_PAGE_MAX:
+            return JsonResponse.create(JsonResponse.LIST_BAD_REQUEST)
+
+        try:
+            expiring = CertificateRenewal().expiring(within, limit)
+        except CertificateIndexReconcilingError:
+            return JsonResponse.create(JsonResponse.CERT_INDEX_RECONCILING)
+        except Exception as error:
+            self._logger.error('Unable to list expiring certificates.')
+            self._logger.info(error)
+            return JsonResponse.create(JsonResponse.READ_SECRET_FAIL)
+
+        return {'certificates': expiring}
+
+
+class NodeCertsRenewed(Resource):
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+
+    def get(self, serial):
+        '''[summary]
+        Get the renewed certificate of a client.
+        [description]
+        Returns the certificate issued to replace the one identified by the serial,
+        along with its private key.
+
+        Arguments:
+            [type] string -- [description] serial of the expiring certificate
+        '''
+        self._logger.info('Node Certs endpoint method GET renewal of serial %s from %s', serial, request.remote_addr)
+
+        try:
+            renewal = CertificateRenewal().renewal(serial)
+        except Exception as error:
+            self._logger.error('Unable to read renewed certificate.')
+            self._logger.info(error)
+            return JsonResponse.create(JsonResponse.READ_SECRET_FAIL)
+
+        if renewal is None:
+            return JsonResponse.create(JsonResponse.SECRET_NOT_EXIST)
+
+        return Response(renewal['certificate'], 200)
@@ -2,26 +2,34 @@ import logging
 from flask import request, Response
 from flask_restful import Resource
 from requests import exceptions
-from lib.vault_backend import VaultPkiBackend
+from lib.pki_cache import PkiCache
+from lib.resilience import CircuitBreakerOpenError
 from lib.json_response import JsonResponse
 
 
 class NodeCrl(Resource):
     def __init__(self):
         self._logger = logging.getLogger('flask.app')
-        self._vault_backend = VaultPkiBackend()
+        self._pki_cache = PkiCache()
 
     def get(self):
         '''[summary]
         Get the Certificate Revocation List for worker node certificates
+        [description]
+        Served from cache, supports conditional requests with ETag and Last-Modified.
         '''
         self._logger.info('Node CRL endpoint method GET from %s', request.remote_addr)
 
         try:
-            crl = self._vault_backend.getAnonymous('/v1/pki/crl/pem')
+            crl, resp = self._pki_cache.get('crl')
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except exceptions.RequestException as error:
             self._logger.error('Unable to get CRL from Vault.')
             self._logger.info(error)
             return JsonResponse.create(JsonResponse.READ_SECRET_FAIL)
 
-        return Response(crl.text, crl.status_code)
+        if crl is None:
+            return Response(resp.text, resp.status_code)
+
+        return crl.response()
@@ -0,0 +1,24 @@
+import logging
+from flask import request
+from flask_restful import Resource
+from lib.startup import is_ready, readiness
+
+
+class Readiness(Resource):
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+
+    def get(self):
+        '''[summary]
+        Report whether the backends are initialized
+        [description]
+
+        Returns:
+            [type] json -- [description] state of every backend, with HTTP status 200 if every
+            required backend is ready and 503 otherwise
+        '''
+        self._logger.debug('Readiness endpoint method GET from %s', request.remote_addr)
+
+        ready = is_ready()
+
+        return {'ready': ready, 'backends': readiness()}, 200 if ready else 503
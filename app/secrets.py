@@ -1,8 +1,107 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from flask_restful import request, Resource
 from hvac import exceptions
-from lib.vault_backend import VaultBackend
+from lib.secret_cache import SecretCache
+from lib.vault_backend import VaultBackend, VaultBackendConflictError, VaultBackendUnsupportedError
 from lib.json_response import JsonResponse
+from lib.resilience import CircuitBreakerOpenError
+
+
+# Maximum number of Vault requests in flight for batch requests
+SECRETS_BATCH_CONCURRENCY = 8
+
+# Maximum number of secrets in one batch request
+SECRETS_BATCH_MAX = 100
+
+
+def _version(value, minimum=1):
+    '''[summary]
+    Validate a version or cas parameter
+    [description]
+    Returns:
+        [type] int -- [description] the version, None if not given
+
+    Raises:
+        ValueError -- not an integer of at least minimum
+    '''
+    if value is None:
+        return None
+
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+
+    version = int(value)
+
+    if version < minimum:
+        raise ValueError(value)
+
+    return version
+
+
+def _write_secret(vault_backend, secret_name, secret_value, cas=None):
+    if not secret_name or not secret_value:
+        return JsonResponse.WRITE_SECRET_BAD_REQUEST, None
+
+    try:
+        cas = _version(cas, 0)
+    except ValueError:
+        return JsonResponse.VERSION_BAD_REQUEST, None
+
+    try:
+        version = vault_backend.write_secret(secret_name, secret_value, cas)
+    except VaultBackendUnsupportedError:
+        return JsonResponse.VERSION_BAD_REQUEST, None
+    except VaultBackendConflictError:
+        return JsonResponse.WRITE_SECRET_CONFLICT, None
+    except CircuitBreakerOpenError:
+        return JsonResponse.VAULT_UNAVAILABLE, None
+    except Exception as error:
+        logging.getLogger('flask.app').exception(error)
+        return JsonResponse.WRITE_SECRET_FAIL, None
+    finally:
+        SecretCache().invalidate(secret_name)
+
+    return JsonResponse.WRITE_SECRET_SUCCESS, {'version': version} if version is not None else None
+
+
+def _read_secret(vault_backend, secret_name, version=None):
+    if not secret_name:
+        return JsonResponse.READ_SECRET_BAD_REQUEST, None
+
+    try:
+        if version is None:
+            secret = SecretCache().read(secret_name, vault_backend.read_secret)
+        else:
+            secret = vault_backend.read_secret(secret_name, version)
+    except VaultBackendUnsupportedError:
+        return JsonResponse.VERSION_BAD_REQUEST, None
+    except exceptions.InvalidPath:
+        return JsonResponse.SECRET_NOT_EXIST, None
+    except CircuitBreakerOpenError:
+        return JsonResponse.VAULT_UNAVAILABLE, None
+    except Exception as error:
+        logging.getLogger('flask.app').exception(error)
+        return JsonResponse.READ_SECRET_FAIL, None
+
+    return JsonResponse.READ_SECRET_SUCCESS, secret['data']
+
+
+def _delete_secret(vault_backend, secret_name):
+    if not secret_name:
+        return JsonResponse.DELETE_SECRET_BAD_REQUEST, None
+
+    try:
+        vault_backend.delete_secret(secret_name)
+    except CircuitBreakerOpenError:
+        return JsonResponse.VAULT_UNAVAILABLE, None
+    except Exception as error:
+        logging.getLogger('flask.app').exception(error)
+        return JsonResponse.DELETE_SECRET_FAIL, None
+    finally:
+        SecretCache().invalidate(secret_name)
+
+    return JsonResponse.DELETE_SECRET_SUCCESS, None
 
 
 class Secrets(Resource):
@@ -18,55 +117,45 @@ class Secrets(Resource):
         Arguments:
             name -- name of secret
             value -- value of secret
+            cas -- optional, with KV version 2 only write if the secret has this version, 0 if it must not exist
         '''
         secret_name = request.json['name']
         secret_value = request.json['value']
 
         self._logger.info('Secrets endpoint method POST secret "%s" from %s', secret_name, request.remote_addr)
 
-        if not secret_name or not secret_value:
-            return JsonResponse.create(JsonResponse.WRITE_SECRET_BAD_REQUEST)
-
-        secret = {'secret_value': secret_value}
-
-        try:
-            self._vault_backend.client.secrets.kv.v1.create_or_update_secret(path=secret_name, secret=secret)
-        except Exception as error:
-            self._logger.exception(error)
-            return JsonResponse.create(JsonResponse.WRITE_SECRET_FAIL)
-
-        return JsonResponse.create(JsonResponse.WRITE_SECRET_SUCCESS)
+        return JsonResponse.create(*_write_secret(self._vault_backend, secret_name, secret_value,
+                                                  request.json.get('cas')))
 
     def get(self, secret_name):
         '''[summary]
         Read a secret from the vault
         [description]
 
+        Arguments:
+            version -- optional query parameter, version to read with KV version 2
+
         Returns:
             [type] json -- [description] a dictionary of secret data and associated metadata as per Vault documentation
         '''
         self._logger.info('Secrets endpoint method GET secret "%s" from %s', secret_name, request.remote_addr)
 
-        if not secret_name:
-            return JsonResponse.create(JsonResponse.READ_SECRET_BAD_REQUEST)
-
         try:
-            secret = self._vault_backend.client.secrets.kv.v1.read_secret(path=secret_name)
-        except exceptions.InvalidPath as error:
-            return JsonResponse.create(JsonResponse.SECRET_NOT_EXIST)
-        except Exception as error:
-            self._logger.exception(error)
-            return JsonResponse.create(JsonResponse.READ_SECRET_FAIL)
+            version = _version(request.args.get('version'))
+        except ValueError:
+            return JsonResponse.create(JsonResponse.VERSION_BAD_REQUEST)
 
-        return JsonResponse.create(JsonResponse.READ_SECRET_SUCCESS, secret['data'])
+        return JsonResponse.create(*_read_secret(self._vault_backend, secret_name, version))
 
     def put(self, secret_name):
         '''[summary]
         Update a secret in the vault
         [description]
+        With KV version 2 this is a single request to Vault, failing if the secret does not exist.
 
         Arguments:
             secret_name {[type]} -- [description] Name of secret
+            cas -- optional, with KV version 2 only update if the secret has this version
         '''
         self._logger.info('Secrets endpoint method PUT secret "%s" from %s', secret_name, request.remote_addr)
 
@@ -76,22 +165,31 @@ class Secrets(Resource):
             return JsonResponse.create(JsonResponse.UPDATE_SECRET_BAD_REQUEST)
 
         try:
-            secret = self._vault_backend.client.secrets.kv.v1.read_secret(path=secret_name)
-        except exceptions.InvalidPath as error:
-            return JsonResponse.create(JsonResponse.SECRET_NOT_EXIST)
-        except Exception as error:
-            self._logger.exception(error)
-            return JsonResponse.create(JsonResponse.UPDATE_SECRET_FAIL)
-
-        secret = {'secret_value': secret_value}
+            cas = _version(request.json.get('cas'))
+        except ValueError:
+            return JsonResponse.create(JsonResponse.VERSION_BAD_REQUEST)
 
         try:
-            self._vault_backend.client.secrets.kv.v1.create_or_update_secret(path=secret_name, secret=secret)
+            if cas is None:
+                version = self._vault_backend.update_secret(secret_name, secret_value)
+            else:
+                version = self._vault_backend.write_secret(secret_name, secret_value, cas)
+        except exceptions.InvalidPath:
+            return JsonResponse.create(JsonResponse.SECRET_NOT_EXIST)
+        except VaultBackendUnsupportedError:
+            return JsonResponse.create(JsonResponse.VERSION_BAD_REQUEST)
+        except VaultBackendConflictError:
+            return JsonResponse.create(JsonResponse.WRITE_SECRET_CONFLICT)
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except Exception as error:
             self._logger.exception(error)
             return JsonResponse.create(JsonResponse.UPDATE_SECRET_FAIL)
+        finally:
+            SecretCache().invalidate(secret_name)
 
-        return JsonResponse.create(JsonResponse.UPDATE_SECRET_SUCCESS)
+        return JsonResponse.create(JsonResponse.UPDATE_SECRET_SUCCESS,
+                                   {'version': version} if version is not None else None)
 
     def delete(self, secret_name):
         '''[summary]
@@ -100,13 +198,101 @@ class Secrets(Resource):
         '''
         self._logger.info('Secrets endpoint method DELETE secret "%s" from %s', secret_name, request.remote_addr)
 
-        if not secret_name:
-            return JsonResponse.create(JsonResponse.DELETE_SECRET_BAD_REQUEST)
+        return JsonResponse.create(*_delete_secret(self._vault_backend, secret_name))
+
+
+class SecretsUndelete(Resource):
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+        self._vault_backend = VaultBackend()
+
+    def post(self, secret_name):
+        '''[summary]
+        Restore a deleted secret
+        [description]
+        Restores the latest version of a secret deleted with KV version 2.
+
+        Returns:
+            [type] json -- [description] the restored version
+        '''
+        self._logger.info('Secrets endpoint method POST undelete secret "%s" from %s', secret_name,
+                          request.remote_addr)
 
         try:
-            self._vault_backend.client.secrets.kv.v1.delete_secret(path=secret_name)
+            version = self._vault_backend.undelete_secret(secret_name)
+        except VaultBackendUnsupportedError:
+            return JsonResponse.create(JsonResponse.UNDELETE_SECRET_BAD_REQUEST)
+        except exceptions.InvalidPath:
+            return JsonResponse.create(JsonResponse.SECRET_NOT_DELETED)
+        except CircuitBreakerOpenError:
+            return JsonResponse.create(JsonResponse.VAULT_UNAVAILABLE)
         except Exception as error:
             self._logger.exception(error)
-            return JsonResponse.create(JsonResponse.DELETE_SECRET_FAIL)
+            return JsonResponse.create(JsonResponse.UNDELETE_SECRET_FAIL)
+        finally:
+            SecretCache().invalidate(secret_name)
+
+        return JsonResponse.create(JsonResponse.UNDELETE_SECRET_SUCCESS, {'version': version})
+
+
+class SecretsBatch(Resource):
+    # shared by all requests of the worker, bounds the load put on Vault
+    _executor = ThreadPoolExecutor(max_workers=SECRETS_BATCH_CONCURRENCY, thread_name_prefix='secrets-batch')
+
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+        self._vault_backend = VaultBackend()
+
+    def post(self):
+        '''[summary]
+        Read, write or delete many secrets in the vault
+        [description]
+        The Vault requests are sent concurrently. Every secret gets its own code and
+        message, the same as for a single secret request.
+
+        Arguments:
+            operation -- one of read, write or delete
+            secrets -- list of secret names, or of objects with name and value for write
+
+        Returns:
+            [type] json -- [description] list of results in the order of the request
+        '''
+        body = request.get_json(silent=True)
+
+        if not isinstance(body, dict):
+            return JsonResponse.create(JsonResponse.BATCH_BAD_REQUEST)
+
+        operation = body.get('operation')
+        secrets = body.get('secrets')
+
+        self._logger.info('Secrets endpoint method POST batch %s of %s secrets from %s',
+                          operation, len(secrets) if isinstance(secrets, list) else 0, request.remote_addr)
+
+        if (operation not in ('read', 'write', 'delete') or not isinstance(secrets, list)
+                or not secrets or len(secrets) > SECRETS_BATCH_MAX):
+            return JsonResponse.create(JsonResponse.BATCH_BAD_REQUEST)
+
+        if operation == 'write':
+            if not all(isinstance(secret, dict) for secret in secrets):
+                return JsonResponse.create(JsonResponse.BATCH_BAD_REQUEST)
+
+            names = [secret.get('name') for secret in secrets]
+            futures = [self._executor.submit(_write_secret, self._vault_backend, secret.get('name'),
+                                             secret.get('value'), secret.get('cas'))
+                       for secret in secrets]
+        else:
+            if not all(isinstance(name, str) for name in secrets):
+                return JsonResponse.create(JsonResponse.BATCH_BAD_REQUEST)
+
+            names = secrets
+            func = _read_secret if operation == 'read' else _delete_secret
+            futures = [self._executor.submit(func, self._vault_backend, name) for name in secrets]
+
+        results = []
+        for name, future in zip(names, futures):
+            message_label, payload = future.result()
+            result = {'name': name}
+            result.update(JsonResponse.body(message_label, payload))
+            results.append(result)
 
-        return JsonResponse.create(JsonResponse.DELETE_SECRET_SUCCESS)
+        return JsonResponse.create(JsonResponse.BATCH_SUCCESS, {'results': results})
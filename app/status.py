@@ -0,0 +1,36 @@
+import logging
+from flask import request
+from flask_restful import Resource
+from lib.http_pool import pool_stats
+from lib.resilience import breaker_stats, hedge_stats
+from lib.secret_cache import SecretCache
+from lib.single_flight import single_flight_stats
+from lib.vault_token import VaultTokenManager
+from lib.warm_pool import warm_pool_stats
+
+
+class Status(Resource):
+    def __init__(self):
+        self._logger = logging.getLogger('flask.app')
+
+    def get(self):
+        '''[summary]
+        Report internal state of the security policy manager
+        [description]
+
+        Returns:
+            [type] json -- [description] connection pool statistics per upstream, statistics
+            of the pools of pre-created items, of the Vault token and of the secret cache, and
+            the state of the circuit breakers, hedged reads and coalesced reads per backend
+        '''
+        self._logger.debug('Status endpoint method GET from %s', request.remote_addr)
+
+        return {
+            'http_pools': pool_stats(),
+            'warm_pools': warm_pool_stats(),
+            'vault_token': VaultTokenManager().stats(),
+            'secret_cache': SecretCache().stats(),
+            'circuit_breakers': breaker_stats(),
+            'hedging': hedge_stats(),
+            'single_flight': single_flight_stats()
+        }
@@ -0,0 +1,31 @@
+'''[summary]
+Gunicorn configuration
+[description]
+Initializes the backends once in the master, before the workers are forked, so the
+workers do not repeat the Vault unseal, PKI and Kubernetes setup on their first request.
+Workers retry in the background if the master could not initialize every backend.
+The metrics files of workers that exit are merged into the totals (see lib/metrics.py).
+'''
+import os
+
+
+def on_starting(server):
+    from lib.startup import warm_up
+
+    warm_up(prefork=True)
+
+
+def post_fork(server, worker):
+    from lib.startup import after_fork, is_ready, warm_up_in_background
+
+    after_fork(server.cfg.workers)
+
+    if not is_ready():
+        warm_up_in_background()
+
+
+def child_exit(server, worker):
+    if 'prometheus_multiproc_dir' in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
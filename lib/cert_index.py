@@ -0,0 +1,237 @@
+import fnmatch
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from lib import der
+from lib.pki_cache import PkiCache
+from lib.vault_backend import VaultPkiBackend
+
+
+# Seconds between reconciliations of the index with the Vault PKI
+CERT_INDEX_RECONCILE_INTERVAL = 60
+
+# Maximum number of certificates fetched from Vault concurrently while reconciling
+CERT_INDEX_FETCH_CONCURRENCY = 8
+
+# Default and maximum number of certificates in one page of a listing
+CERT_INDEX_PAGE_SIZE = 100
+CERT_INDEX_PAGE_MAX = 1000
+
+
+class CertificateIndexError(Exception):
+    pass
+
+
+class CertificateIndexReconcilingError(CertificateIndexError):
+    '''[summary]
+    The index is being built from the Vault PKI, in the background
+    '''
+    pass
+
+
+class CertificateIndex:
+    '''[summary]
+    In-memory index of the certificates issued by the Vault PKI
+    [description]
+    Holds serial, common name, validity and revocation of every certificate, so
+    listings can be filtered without a Vault request per certificate. Entries are
+    added when SPM issues or revokes a certificate and the index is reconciled with
+    Vault every CERT_INDEX_RECONCILE_INTERVAL seconds in the background: only serials
+    not in the index yet are fetched, serials removed by a tidy are dropped and the
+    revoked flags are taken from the CRL. The first reconciliation of a worker runs in
+    the background as well, started after the fork, and the index cannot be read until
+    it is done.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _entries = None
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+        if self._entries is None:
+            self._logger = logging.getLogger('flask.app')
+            self._vault_backend = VaultPkiBackend()
+            self._lock = threading.Lock()
+            self._reconcile_lock = threading.Lock()
+            self._pid = None
+            self._reconciled_at = None
+            self._entries = {}
+
+    def add(self, serial, certificate):
+        '''[summary]
+        Index a certificate issued by SPM
+        [description]
+        Arguments:
+            serial -- serial as reported by Vault
+            certificate -- pem certificate or bundle containing it
+        '''
+        try:
+            entry = self._create_entry(certificate)
+        except der.DerError as error:
+            self._logger.info('Unable to index certificate with serial %s.', serial)
+            self._logger.debug(error)
+            return
+
+        with self._lock:
+            self._entries[serial] = entry
+
+    def revoke(self, serial):
+        with self._lock:
+            if serial in self._entries:
+                self._entries[serial]['revoked'] = True
+
+    def query(self, common_name=None, expires_before=None, revoked=None, offset=0, limit=CERT_INDEX_PAGE_SIZE):
+        '''[summary]
+        List indexed certificates, ordered by serial
+        [description]
+        Arguments:
+            common_name -- shell-style pattern the common name must match
+            expires_before -- datetime, only certificates expiring earlier
+            revoked -- True or False to only list revoked or valid certificates
+
+        Returns:
+            [type] dict -- [description] total number of matches and the requested page of them
+        '''
+        entries = sorted(self.snapshot().items())
+
+        matches = []
+        for serial, entry in entries:
+            if common_name is not None and not fnmatch.fnmatchcase(entry['common_name'] or '', common_name):
+                continue
+            if expires_before is not None and entry['not_after'] >= expires_before:
+                continue
+            if revoked is not None and entry['revoked'] != revoked:
+                continue
+
+            matches.append((serial, entry))
+
+        return {
+            'total': len(matches),
+            'offset': offset,
+            'limit': limit,
+            'certificates': [self._serialize(serial, entry) for serial, entry in matches[offset:offset + limit]]
+        }
+
+    def snapshot(self):
+        '''[summary]
+        Copy of the index, by serial
+        [description]
+        Raises:
+            CertificateIndexReconcilingError -- the index was not reconciled with Vault yet in this process
+        '''
+        self.start()
+
+        if self._reconciled_at is None:
+            raise CertificateIndexReconcilingError()
+
+        with self._lock:
+            return {serial: dict(entry) for serial, entry in self._entries.items()}
+
+    def reconcile(self):
+        '''[summary]
+        Bring the index in line with the Vault PKI
+        '''
+        with self._reconcile_lock:
+            resp = self._vault_backend.list('/v1/pki/certs')
+
+            if resp.status_code == 404:
+                serials = []
+            elif resp.status_code != 200:
+                raise CertificateIndexError(resp.text)
+            else:
+                serials = json.loads(resp.text)['data']['keys']
+
+            with self._lock:
+                for serial in set(self._entries) - set(serials):
+                    del self._entries[serial]
+
+                missing = [serial for serial in serials if serial not in self._entries]
+
+            if missing:
+                with ThreadPoolExecutor(max_workers=CERT_INDEX_FETCH_CONCURRENCY) as executor:
+                    for serial, entry in zip(missing, executor.map(self._fetch, missing)):
+                        if entry is not None:
+                            with self._lock:
+                                self._entries.setdefault(serial, entry)
+
+            self._apply_crl()
+
+            self._reconciled_at = time.monotonic()
+
+    def _fetch(self, serial):
+        try:
+            resp = self._vault_backend.getAnonymous('/v1/pki/cert/' + serial)
+
+            if resp.status_code != 200:
+                return None
+
+            return self._create_entry(json.loads(resp.text)['data']['certificate'])
+        except Exception as error:
+            self._logger.info('Unable to index certificate with serial %s.', serial)
+            self._logger.debug(error)
+            return None
+
+    def _apply_crl(self):
+        crl, resp = PkiCache().get('crl')
+
+        if crl is None:
+            raise CertificateIndexError(resp.text)
+
+        revoked = der.parse_crl(der.pem_to_der(crl.body))['revoked']
+
+        with self._lock:
+            for serial, entry in self._entries.items():
+                entry['revoked'] = serial in revoked
+
+    @staticmethod
+    def _create_entry(certificate):
+        info = der.certificate_info(der.pem_to_der(certificate, 'CERTIFICATE'))
+
+        return {
+            'common_name': info['common_name'],
+            'not_before': info['not_before'],
+            'not_after': info['not_after'],
+            'revoked': False
+        }
+
+    @staticmethod
+    def _serialize(serial, entry):
+        return {
+            'serial_number': serial,
+            'common_name': entry['common_name'],
+            'not_before': entry['not_before'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'not_after': entry['not_after'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'revoked': entry['revoked']
+        }
+
+    def start(self):
+        '''[summary]
+        Start the reconciliation in the background, once per process
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+
+            threading.Thread(target=self._run, name='certindex', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as error:
+                self._logger.error('Unable to reconcile certificate index.')
+                self._logger.info(error)
+
+            time.sleep(CERT_INDEX_RECONCILE_INTERVAL)
+
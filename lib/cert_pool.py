@@ -0,0 +1,198 @@
+import json
+import logging
+import time
+import uuid
+from hvac import exceptions
+from lib import vault_backend
+from lib.cert_index import CertificateIndex
+from lib.pki_cache import PkiCache
+from lib.vault_backend import VaultBackend, VaultBackendConflictError, VaultPkiBackend
+from lib.warm_pool import WarmPool, register_warm_pool
+
+
+# Keep a pool of pre-issued worker node certificates
+CERT_POOL_ENABLED = False
+
+# Refill the pool to the high watermark when it drops below the low watermark,
+# both for all the workers together, each worker keeps its share
+CERT_POOL_LOW_WATERMARK = 10
+CERT_POOL_HIGH_WATERMARK = 50
+
+# Seconds after which an unused certificate is revoked
+CERT_POOL_MAX_AGE = 3600
+
+# Vault KV path holding the pooled certificates
+CERT_POOL_PATH = 'certpool'
+
+
+class CertificatePoolError(Exception):
+    pass
+
+
+class CertificatePool:
+    '''[summary]
+    Pre-issued worker node certificates
+    [description]
+    Certificates with random *.workernode.micado common names are issued in the
+    background and stored in Vault KV; only their serials are kept in memory.
+    Unused certificates older than CERT_POOL_MAX_AGE are revoked. A certificate is
+    claimed in Vault KV before it is handed out or revoked, so it is never both.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _pool = None
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+        if not self._pool:
+            self._logger = logging.getLogger('flask.app')
+            self._vault_backend = VaultBackend()
+            self._pki_backend = VaultPkiBackend()
+
+            self._pool = register_warm_pool(WarmPool('certificates', self._issue, self._discard,
+                                                     CERT_POOL_LOW_WATERMARK, CERT_POOL_HIGH_WATERMARK,
+                                                     CERT_POOL_MAX_AGE, sweep=self._sweep, per_deployment=True))
+
+    @staticmethod
+    def _path(serial):
+        return CERT_POOL_PATH + '/' + serial.replace(':', '-')
+
+    def _issue(self):
+        params = {
+            'common_name': uuid.uuid4().hex + '.workernode.micado',
+            'format': 'pem_bundle'
+        }
+
+        resp = self._pki_backend.post('/v1/pki/issue/micado', params)
+
+        if resp.status_code != 200:
+            raise CertificatePoolError(resp.text)
+
+        data = json.loads(resp.text)['data']
+
+        entry = {
+            'common_name': params['common_name'],
+            'serial_number': data['serial_number'],
+            'certificate': data['certificate'],
+            'created': time.time()
+        }
+
+        self._vault_backend.write_secret(self._path(entry['serial_number']), json.dumps(entry))
+
+        CertificateIndex().add(entry['serial_number'], entry['certificate'])
+
+        return entry['serial_number']
+
+    def _claim(self, path):
+        '''[summary]
+        Remove a pooled certificate from Vault KV, unless another process did first
+        [description]
+        With KV version 2 the entry is overwritten with a claim marker guarded by
+        check-and-set, so only one process wins it, then purged. KV version 1 has no
+        check-and-set: the entry is read and purged, and only the sweep, which waits
+        until the process holding a certificate would have expired it, can race.
+
+        Returns:
+            [type] dict -- [description] the entry, or None if it was claimed by another process
+        '''
+        try:
+            secret = self._vault_backend.read_secret(path)['data']
+        except exceptions.InvalidPath:
+            return None
+
+        entry = json.loads(secret['secret_value'])
+
+        if 'claimed' in entry:
+            return None
+
+        if vault_backend.VAULT_KV_VERSION == 2:
+            try:
+                self._vault_backend.write_secret(path, json.dumps(dict(entry, claimed=time.time())),
+                                                 cas=secret['version'])
+            except VaultBackendConflictError:
+                return None
+
+        self._vault_backend.purge_secret(path)
+
+        return entry
+
+    def _discard(self, serial):
+        if self._claim(self._path(serial)) is not None:
+            self._revoke(serial)
+
+    def _revoke(self, serial):
+        self._logger.info('Revoking unused pooled certificate with serial %s', serial)
+
+        resp = self._pki_backend.post('/v1/pki/revoke', {'serial_number': serial})
+
+        if resp.status_code != 200:
+            raise CertificatePoolError(resp.text)
+
+        PkiCache().invalidate('crl')
+        CertificateIndex().revoke(serial)
+
+    def _sweep(self, held):
+        '''[summary]
+        Revoke pooled certificates left behind by other processes
+        '''
+        held = set(self._path(serial) for serial in held)
+
+        try:
+            keys = self._vault_backend.list_secrets(CERT_POOL_PATH)
+        except exceptions.InvalidPath:
+            return
+
+        for key in keys:
+            path = CERT_POOL_PATH + '/' + key
+
+            if path in held:
+                continue
+
+            try:
+                entry = json.loads(self._vault_backend.read_secret(path)['data']['secret_value'])
+            except exceptions.InvalidPath:
+                continue
+
+            if 'claimed' in entry:
+                # the process that claimed it died before purging it
+                if time.time() - entry['claimed'] > CERT_POOL_MAX_AGE:
+                    self._vault_backend.purge_secret(path)
+                continue
+
+            # the process holding it expires it after CERT_POOL_MAX_AGE, unless it died
+            if time.time() - entry['created'] > 2 * CERT_POOL_MAX_AGE and self._claim(path) is not None:
+                self._revoke(entry['serial_number'])
+
+    def take(self):
+        '''[summary]
+        Take a pre-issued certificate
+        [description]
+        Returns:
+            [type] dict -- [description] serial_number and certificate (pem bundle), or None if the pool is empty
+        '''
+        while True:
+            serial = self._pool.take()
+
+            if serial is None:
+                return None
+
+            try:
+                entry = self._claim(self._path(serial))
+            except Exception as error:
+                self._logger.error('Unable to take certificate from pool.')
+                self._logger.info(error)
+                return None
+
+            if entry is None:
+                # revoked by another process meanwhile
+                continue
+
+            self._logger.info('Handing out pooled certificate with serial %s', serial)
+
+            return entry
+
+    def stats(self):
+        return self._pool.stats()
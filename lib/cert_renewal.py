@@ -0,0 +1,273 @@
+import datetime
+import fcntl
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from hvac import exceptions
+from lib.cert_index import CertificateIndex, CertificateIndexReconcilingError
+from lib.vault_backend import VaultBackend, VaultPkiBackend
+
+
+# Renew worker node certificates before they expire
+CERT_RENEWAL_ENABLED = False
+
+# Seconds before notAfter a certificate is renewed
+CERT_RENEWAL_WINDOW = 14 * 24 * 3600
+
+# Seconds between scans of the certificates
+CERT_RENEWAL_INTERVAL = 60
+
+# Maximum number of certificates renewed per scan
+CERT_RENEWAL_BATCH = 20
+
+# Seconds between tidy runs of the Vault PKI, removing expired and revoked certificates
+CERT_TIDY_INTERVAL = 24 * 3600
+
+# Seconds past notAfter a certificate is kept by the tidy
+CERT_TIDY_SAFETY_BUFFER = 72 * 3600
+
+# Vault KV path holding the renewed certificates, by serial of the old certificate
+CERT_RENEWAL_PATH = 'certrenewal'
+
+# File locked by the worker running the scheduler, only one worker renews
+CERT_RENEWAL_LOCK_FILE = 'certrenewal.lock'
+
+
+class CertificateRenewalError(Exception):
+    pass
+
+
+class CertificateRenewal:
+    '''[summary]
+    Expiry scanner and renewal scheduler of worker node certificates
+    [description]
+    The certificates of the index are kept in a heap keyed by notAfter. Every
+    CERT_RENEWAL_INTERVAL seconds up to CERT_RENEWAL_BATCH certificates expiring within
+    CERT_RENEWAL_WINDOW are renewed: a new certificate with the same common name is
+    issued and stored in Vault KV under the serial of the old one, for the node to
+    fetch. The old certificate stays valid until it expires. Every CERT_TIDY_INTERVAL
+    seconds the Vault PKI is tidied. Only the worker holding CERT_RENEWAL_LOCK_FILE runs
+    the scheduler.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _heap = None
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+        if self._heap is None:
+            self._logger = logging.getLogger('flask.app')
+            self._lock = threading.Lock()
+            self._pid = None
+            self._lock_file = None
+            self._scheduled = set()
+            self._renewed = set()
+            self._last_tidy = time.monotonic()
+            self._heap = []
+
+    @staticmethod
+    def _path(serial):
+        return CERT_RENEWAL_PATH + '/' + serial.replace(':', '-')
+
+    def start(self):
+        '''[summary]
+        Start the scheduler in this process, if no other worker runs it
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+
+            threading.Thread(target=self._run, name='certrenewal', daemon=True).start()
+
+    def _acquire(self):
+        if self._lock_file is not None:
+            return True
+
+        lock_file = open(CERT_RENEWAL_LOCK_FILE, 'a')
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._logger.info('Running certificate renewal scheduler in process %s.', os.getpid())
+
+        self._lock_file = lock_file
+        self._renewed = self._load_renewed()
+
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(CERT_RENEWAL_INTERVAL)
+
+            try:
+                if not self._acquire():
+                    continue
+
+                self.scan()
+
+                if time.monotonic() - self._last_tidy > CERT_TIDY_INTERVAL:
+                    self._last_tidy = time.monotonic()
+                    self.tidy()
+            except CertificateIndexReconcilingError:
+                self._logger.info('Certificate index not built yet, renewals wait for the next run.')
+            except Exception as error:
+                self._logger.error('Certificate renewal scheduler failed.')
+                self._logger.info(error)
+
+    def scan(self):
+        '''[summary]
+        Renew the certificates closest to expiry
+        [description]
+        Returns:
+            [type] list -- [description] serials of the renewed certificates
+        '''
+        index = CertificateIndex().snapshot()
+
+        self._scheduled &= set(index)
+
+        for serial, entry in index.items():
+            if serial not in self._scheduled:
+                self._scheduled.add(serial)
+                heapq.heappush(self._heap, (entry['not_after'], serial))
+
+        # renewals of certificates the tidy removed are not needed any more
+        for serial in [serial for serial in self._renewed if serial not in index]:
+            self._forget(serial)
+
+        cutoff = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=CERT_RENEWAL_WINDOW)
+        renewed = []
+
+        while self._heap and self._heap[0][0] <= cutoff and len(renewed) < CERT_RENEWAL_BATCH:
+            not_after, serial = heapq.heappop(self._heap)
+
+            entry = index.get(serial)
+
+            if entry is None or entry['revoked'] or not entry['common_name'] or serial in self._renewed:
+                continue
+
+            if not_after <= datetime.datetime.now(datetime.timezone.utc):
+                continue
+
+            try:
+                self._renew(serial, entry['common_name'])
+            except Exception as error:
+                self._logger.error('Unable to renew certificate with serial %s.', serial)
+                self._logger.info(error)
+
+                # try again on the next scan
+                heapq.heappush(self._heap, (not_after, serial))
+                break
+
+            renewed.append(serial)
+
+        return renewed
+
+    def _renew(self, serial, common_name):
+        params = {
+            'common_name': common_name,
+            'format': 'pem_bundle'
+        }
+
+        resp = VaultPkiBackend().post('/v1/pki/issue/micado', params)
+
+        if resp.status_code != 200:
+            raise CertificateRenewalError(resp.text)
+
+        data = json.loads(resp.text)['data']
+
+        renewal = {
+            'common_name': common_name,
+            'serial_number': data['serial_number'],
+            'certificate': data['certificate'],
+            'created': time.time()
+        }
+
+        VaultBackend().write_secret(self._path(serial), json.dumps(renewal))
+        CertificateIndex().add(data['serial_number'], data['certificate'])
+
+        self._renewed.add(serial)
+
+        self._logger.info('Renewed certificate with serial %s as %s', serial, data['serial_number'])
+
+    def _load_renewed(self):
+        try:
+            keys = VaultBackend().list_secrets(CERT_RENEWAL_PATH)
+        except exceptions.InvalidPath:
+            return set()
+
+        return set(key.replace('-', ':') for key in keys)
+
+    def _forget(self, serial):
+        try:
+            VaultBackend().purge_secret(self._path(serial))
+        except exceptions.InvalidPath:
+            pass
+
+        self._renewed.discard(serial)
+
+    def tidy(self):
+        '''[summary]
+        Remove expired and revoked certificates from the Vault PKI
+        '''
+        params = {
+            'tidy_cert_store': True,
+            'tidy_revoked_certs': True,
+            'safety_buffer': '%ss' % CERT_TIDY_SAFETY_BUFFER
+        }
+
+        resp = VaultPkiBackend().post('/v1/pki/tidy', params)
+
+        if resp.status_code not in (200, 202, 204):
+            raise CertificateRenewalError(resp.text)
+
+        self._logger.info('Started tidy of the Vault PKI.')
+
+    def renewal(self, serial):
+        '''[summary]
+        Get the renewed certificate of a serial
+        [description]
+        Returns:
+            [type] dict -- [description] common_name, serial_number and certificate (pem bundle), or None
+        '''
+        try:
+            return json.loads(VaultBackend().read_secret(self._path(serial))['data']['secret_value'])
+        except exceptions.InvalidPath:
+            return None
+
+    def expiring(self, within=CERT_RENEWAL_WINDOW, limit=None):
+        '''[summary]
+        List the valid certificates expiring soonest
+        [description]
+        Arguments:
+            within -- seconds from now
+
+        Returns:
+            [type] list -- [description] serial_number, common_name, not_after and renewed, ordered by not_after
+        '''
+        renewed = self._load_renewed()
+
+        cutoff = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=within)
+
+        expiring = [(entry['not_after'], serial, entry) for serial, entry in CertificateIndex().snapshot().items()
+                    if not entry['revoked'] and entry['not_after'] <= cutoff]
+
+        return [{
+            'serial_number': serial,
+            'common_name': entry['common_name'],
+            'not_after': not_after.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'renewed': serial in renewed
+        } for not_after, serial, entry in heapq.nsmallest(limit or len(expiring), expiring)]
@@ -0,0 +1,256 @@
+'''[summary]
+Minimal DER reader
+[description]
+Just enough ASN.1 DER parsing to read the fields SPM needs from certificates, certificate
+signing requests and CRLs of the Vault PKI, without depending on a crypto library.
+'''
+import base64
+import datetime
+
+
+TAG_INTEGER = 0x02
+TAG_SEQUENCE = 0x30
+TAG_VERSION = 0xa0
+TAG_UTC_TIME = 0x17
+TAG_GENERALIZED_TIME = 0x18
+TAG_OID = 0x06
+TAG_ATTRIBUTES = 0xa0
+
+OID_COMMON_NAME = b'\x55\x04\x03'
+
+
+class DerError(ValueError):
+    pass
+
+
+def pem_to_der(pem, label=None):
+    '''[summary]
+    Decode the first PEM block
+    [description]
+    Arguments:
+        label -- only consider blocks of this type, e.g. 'CERTIFICATE' in a pem bundle
+    '''
+    if isinstance(pem, bytes):
+        pem = pem.decode('ASCII')
+
+    lines = pem.strip().splitlines()
+    begin_line = '-----BEGIN ' + label + '-----' if label else '-----BEGIN'
+
+    try:
+        begin = next(index for index, line in enumerate(lines) if line.startswith(begin_line))
+        end = next(index for index, line in enumerate(lines) if index > begin and line.startswith('-----END'))
+    except StopIteration:
+        raise DerError('No PEM block found.')
+
+    try:
+        return base64.b64decode(''.join(lines[begin + 1:end]))
+    except ValueError:
+        raise DerError('Invalid PEM block.')
+
+
+def read_tlv(data, offset):
+    '''[summary]
+    Read the element starting at offset
+    [description]
+    Returns:
+        [type] tuple -- [description] tag, start and end offset of the value
+    '''
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+
+        if length & 0x80:
+            count = length & 0x7f
+            length = int.from_bytes(data[offset:offset + count], 'big')
+            offset += count
+    except IndexError:
+        raise DerError('Truncated element.')
+
+    if offset + length > len(data):
+        raise DerError('Truncated element.')
+
+    return tag, offset, offset + length
+
+
+def elements(data, start, end):
+    '''[summary]
+    Iterate over the elements of a constructed value, including their header
+    [description]
+    Yields:
+        [type] tuple -- [description] tag, start of the element, start and end of its value
+    '''
+    while start < end:
+        tag, value_start, value_end = read_tlv(data, start)
+        yield tag, start, value_start, value_end
+        start = value_end
+
+
+def children(data, start, end):
+    '''[summary]
+    Iterate over the elements of a constructed value
+    '''
+    for tag, element_start, value_start, value_end in elements(data, start, end):
+        yield tag, value_start, value_end
+
+
+def _tbs_fields(der):
+    tag, start, end = read_tlv(der, 0)
+    tag, start, end = read_tlv(der, start)
+
+    if tag != TAG_SEQUENCE:
+        raise DerError('Not a signed structure.')
+
+    return list(elements(der, start, end))
+
+
+def _certificate_fields(der):
+    fields = _tbs_fields(der)
+
+    # skip the optional version
+    if fields and fields[0][0] == TAG_VERSION:
+        fields = fields[1:]
+
+    # serial, signature algorithm, issuer, validity, subject, public key info
+    if len(fields) < 6:
+        raise DerError('Not a certificate.')
+
+    return fields
+
+
+def certificate_public_key_info(der):
+    '''[summary]
+    Get the DER encoded SubjectPublicKeyInfo of a certificate
+    '''
+    tag, element_start, value_start, value_end = _certificate_fields(der)[5]
+
+    return der[element_start:value_end]
+
+
+def certificate_info(der):
+    '''[summary]
+    Read the serial, subject common name and validity of a certificate
+    [description]
+    Returns:
+        [type] dict -- [description] serial_number (Vault format), common_name (None if absent),
+        not_before and not_after
+    '''
+    fields = _certificate_fields(der)
+
+    tag, element_start, serial_start, serial_end = fields[0]
+    tag, element_start, validity_start, validity_end = fields[3]
+    tag, element_start, subject_start, subject_end = fields[4]
+
+    times = list(children(der, validity_start, validity_end))
+
+    if len(times) != 2:
+        raise DerError('Invalid validity.')
+
+    return {
+        'serial_number': format_serial(der[serial_start:serial_end]),
+        'common_name': _common_name(der, subject_start, subject_end),
+        'not_before': parse_time(times[0][0], der[times[0][1]:times[0][2]]),
+        'not_after': parse_time(times[1][0], der[times[1][1]:times[1][2]])
+    }
+
+
+def csr_info(der):
+    '''[summary]
+    Read the subject common name of a certificate signing request (PKCS #10)
+    [description]
+    The signature is not verified, Vault does when it signs the request.
+
+    Returns:
+        [type] dict -- [description] common_name (None if absent)
+    '''
+    fields = _tbs_fields(der)
+
+    # version, subject, public key info and the attributes
+    if len(fields) != 4 or fields[0][0] != TAG_INTEGER or fields[3][0] != TAG_ATTRIBUTES:
+        raise DerError('Not a certificate signing request.')
+
+    tag, element_start, subject_start, subject_end = fields[1]
+
+    return {
+        'common_name': _common_name(der, subject_start, subject_end)
+    }
+
+
+def _common_name(der, subject_start, subject_end):
+    common_name = None
+
+    for tag, rdn_start, rdn_end in children(der, subject_start, subject_end):
+        for tag, attribute_start, attribute_end in children(der, rdn_start, rdn_end):
+            oid_tag, oid_start, oid_end = read_tlv(der, attribute_start)
+            value_tag, value_start, value_end = read_tlv(der, oid_end)
+
+            if oid_tag == TAG_OID and der[oid_start:oid_end] == OID_COMMON_NAME:
+                common_name = der[value_start:value_end].decode('utf-8', 'replace')
+
+    return common_name
+
+
+def parse_time(tag, value):
+    value = value.decode('ASCII')
+
+    if tag == TAG_UTC_TIME:
+        parsed = datetime.datetime.strptime(value, '%y%m%d%H%M%SZ')
+    elif tag == TAG_GENERALIZED_TIME:
+        parsed = datetime.datetime.strptime(value, '%Y%m%d%H%M%SZ')
+    else:
+        raise DerError('Not a time.')
+
+    return parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def format_serial(value):
+    '''[summary]
+    Format a serial number the way Vault does, e.g. 1f:0a:...
+    '''
+    value = value.lstrip(b'\x00') or b'\x00'
+
+    return ':'.join('%02x' % byte for byte in value)
+
+
+def parse_crl(der):
+    '''[summary]
+    Read a certificate revocation list
+    [description]
+    Returns:
+        [type] dict -- [description] this_update, next_update (None if absent) and the set of revoked serials
+    '''
+    tag, start, end = read_tlv(der, 0)
+    tag, start, end = read_tlv(der, start)
+
+    if tag != TAG_SEQUENCE:
+        raise DerError('Not a CRL.')
+
+    fields = list(children(der, start, end))
+
+    # skip the optional version
+    if fields and fields[0][0] == TAG_INTEGER:
+        fields = fields[1:]
+
+    # signature algorithm and issuer come first
+    times = [field for field in fields[2:] if field[0] in (TAG_UTC_TIME, TAG_GENERALIZED_TIME)]
+
+    if not times:
+        raise DerError('CRL without thisUpdate.')
+
+    crl = {
+        'this_update': parse_time(times[0][0], der[times[0][1]:times[0][2]]),
+        'next_update': None,
+        'revoked': set()
+    }
+
+    if len(times) > 1:
+        crl['next_update'] = parse_time(times[1][0], der[times[1][1]:times[1][2]])
+
+    revoked = [field for field in fields[2:] if field[0] == TAG_SEQUENCE]
+
+    if revoked:
+        for tag, entry_start, entry_end in children(der, revoked[0][1], revoked[0][2]):
+            serial_tag, serial_start, serial_end = read_tlv(der, entry_start)
+            crl['revoked'].add(format_serial(der[serial_start:serial_end]))
+
+    return crl
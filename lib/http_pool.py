@@ -0,0 +1,184 @@
+import logging
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Number of keep-alive connections kept open per upstream host
+HTTP_POOL_SIZE = 32
+
+# Seconds to wait for a TCP connection and for a response, respectively
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 30
+
+# Number of retries for failed connections and idempotent requests
+HTTP_RETRIES = 3
+
+# Exponential backoff factor between retries, in seconds
+HTTP_BACKOFF_FACTOR = 0.2
+
+# HTTP statuses that are retried for idempotent requests
+HTTP_RETRY_STATUSES = (502, 503, 504)
+
+# Methods that are safe to retry on a bad status
+HTTP_RETRY_METHODS = frozenset(['GET', 'HEAD', 'LIST', 'OPTIONS'])
+
+
+def _make_retry(retries, backoff_factor):
+    params = {
+        'total': retries,
+        'connect': retries,
+        'read': 0,
+        'status': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': HTTP_RETRY_STATUSES,
+        'raise_on_status': False
+    }
+
+    # urllib3 < 1.26 only knows the old name of the option
+    try:
+        return Retry(allowed_methods=HTTP_RETRY_METHODS, **params)
+    except TypeError:
+        return Retry(method_whitelist=HTTP_RETRY_METHODS, **params)
+
+
+class HttpSessionPool:
+    '''[summary]
+    Shared keep-alive HTTP session
+    [description]
+    Wraps a requests.Session with a bounded connection pool, default timeouts and
+    retry/backoff. The session is safe to share between threads and is recreated
+    lazily in a forked child, so sockets are never shared between gunicorn workers.
+    '''
+
+    def __init__(self, name, pool_size=HTTP_POOL_SIZE, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                 retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+        self.name = name
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._requests = 0
+        self._errors = 0
+
+    @property
+    def session(self):
+        session = self._session
+
+        if session is not None and self._pid == os.getpid():
+            return session
+
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                self._session = self._create_session()
+                self._pid = os.getpid()
+                self._requests = 0
+                self._errors = 0
+
+            return self._session
+
+    def _create_session(self):
+        logging.getLogger('flask.app').info('Creating HTTP connection pool "%s" with %s connections.',
+                                            self.name, self.pool_size)
+
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                              max_retries=_make_retry(self.retries, self.backoff_factor), pool_block=False)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        session = self.session
+
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._requests += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._pid = None
+
+    def stats(self):
+        '''[summary]
+        Connection pool statistics
+        [description]
+        Pool hits are requests served over an already open keep-alive connection.
+
+        Returns:
+            [type] dict -- [description] request, connection and pool hit counters
+        '''
+        connections = 0
+        pool_requests = 0
+
+        session = self._session
+
+        if session is not None and self._pid == os.getpid():
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    connections += pool.num_connections
+                    pool_requests += pool.num_requests
+
+        return {
+            'pool_size': self.pool_size,
+            'requests': self._requests,
+            'errors': self._errors,
+            'connections_opened': connections,
+            'pool_hits': max(pool_requests - connections, 0)
+        }
+
+
+_pools = {}
+
+_pools_lock = threading.Lock()
+
+
+def get_session_pool(name, **kwargs):
+    '''[summary]
+    Get the shared session pool with the given name
+    [description]
+    The pool is created with the given settings on first use and shared afterwards.
+    '''
+    pool = _pools.get(name)
+
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = HttpSessionPool(name, **kwargs)
+                _pools[name] = pool
+
+    return pool
+
+
+def pool_stats():
+    return {name: pool.stats() for name, pool in list(_pools.items())}
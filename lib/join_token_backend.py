@@ -0,0 +1,282 @@
+import base64
+import datetime
+import hashlib
+import logging
+import re
+import secrets
+import subprocess
+import threading
+import yaml
+from lib import der
+from lib.kubernetes_backend import KubernetesBackend
+from lib.metrics import timed
+from lib.warm_pool import WarmPool, register_warm_pool
+
+
+# How join tokens are managed: 'native' creates bootstrap token secrets through the
+# Kubernetes API, 'kubeadm' calls kubeadm token
+JOIN_TOKEN_MODE = 'native'
+
+# Seconds a join token is valid
+JOIN_TOKEN_TTL = 24 * 3600
+
+# Groups the nodes joining with the token authenticate as, the same as kubeadm
+JOIN_TOKEN_GROUPS = 'system:bootstrappers:kubeadm:default-node-token'
+
+BOOTSTRAP_TOKEN_NAMESPACE = 'kube-system'
+
+BOOTSTRAP_TOKEN_PREFIX = 'bootstrap-token-'
+
+TOKEN_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+TOKEN_PATTERN = re.compile(r'^([a-z0-9]{6})(\.[a-z0-9]{16})?$')
+
+# Keep a pool of pre-created join tokens for bursts of joining nodes
+JOIN_TOKEN_POOL_ENABLED = False
+
+# Refill the pool to the high watermark when it drops below the low watermark
+JOIN_TOKEN_POOL_LOW_WATERMARK = 5
+JOIN_TOKEN_POOL_HIGH_WATERMARK = 20
+
+# Seconds a pooled token is valid, and seconds after which an unused one is deleted,
+# so a token handed out is still valid for at least the difference
+JOIN_TOKEN_POOL_TTL = 3600
+JOIN_TOKEN_POOL_MAX_AGE = 1800
+
+# Label of the bootstrap token secrets created for the pool, for operators
+JOIN_TOKEN_POOL_LABEL = 'app.micado/jointokenpool'
+
+# Maximum number of tokens created by one request
+JOIN_TOKEN_BATCH_MAX = 100
+
+# Seconds kubeadm may take before it is killed
+JOIN_TOKEN_KUBEADM_TIMEOUT = 30
+
+COMMAND_TOKEN_PATTERN = re.compile(r'--token\s+(\S+)')
+
+
+class JoinTokenError(Exception):
+    pass
+
+
+class JoinTokenNotFoundError(Exception):
+    pass
+
+
+class JoinTokenBackend:
+    '''[summary]
+    Kubernetes join tokens
+    [description]
+    In native mode bootstrap tokens are created and deleted as secrets in kube-system
+    with the client of KubernetesBackend, and the join command is built in-process from
+    the API server address and the hash of the cluster CA, which is computed once.
+    In kubeadm mode every call runs kubeadm token.
+
+    With JOIN_TOKEN_POOL_ENABLED short lived tokens are created ahead of time by a
+    WarmPool and handed out first; unused ones are deleted after JOIN_TOKEN_POOL_MAX_AGE.
+    Tokens left behind by a dead process expire after JOIN_TOKEN_POOL_TTL and are
+    removed by the token cleaner of the controller manager.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _initialized = False
+
+    _init_lock = threading.Lock()
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    self._init()
+
+    def _init(self):
+        self._logger = logging.getLogger('flask.app')
+
+        if JOIN_TOKEN_MODE == 'native':
+            self._kubernetes_backend = KubernetesBackend()
+            self._join_address = None
+            self._ca_cert_hash = None
+
+        self._pool = None
+
+        if JOIN_TOKEN_POOL_ENABLED:
+            self._pool = register_warm_pool(WarmPool('jointokens', self._create_pooled_token, self._discard_token,
+                                                     JOIN_TOKEN_POOL_LOW_WATERMARK, JOIN_TOKEN_POOL_HIGH_WATERMARK,
+                                                     JOIN_TOKEN_POOL_MAX_AGE))
+
+        self._initialized = True
+
+    def take_tokens(self, count=1):
+        '''[summary]
+        Get join tokens for new nodes
+        [description]
+        Pooled tokens are handed out first, the rest are created on the spot.
+
+        Returns:
+            [type] list -- [description] the kubeadm join commands, one per token
+        '''
+        if self._pool is None:
+            return [self.create_token() for _ in range(count)]
+
+        return [self._pool.take_or_create() for _ in range(count)]
+
+    def create_token(self, ttl=JOIN_TOKEN_TTL, labels=None):
+        '''[summary]
+        Create a join token
+        [description]
+        Arguments:
+            ttl -- seconds the token is valid
+            labels -- labels of the bootstrap token secret (native mode)
+
+        Returns:
+            [type] string -- [description] the kubeadm join command using the token
+        '''
+        if JOIN_TOKEN_MODE == 'kubeadm':
+            return self._kubeadm('create', '--print-join-command', '--ttl', '%ss' % ttl)
+
+        token_id = ''.join(secrets.choice(TOKEN_CHARS) for _ in range(6))
+        token_secret = ''.join(secrets.choice(TOKEN_CHARS) for _ in range(16))
+
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+
+        api = self._kubernetes_backend.api
+
+        secret = {
+            'apiVersion': 'v1',
+            'kind': 'Secret',
+            'type': 'bootstrap.kubernetes.io/token',
+            'metadata': {
+                'name': BOOTSTRAP_TOKEN_PREFIX + token_id,
+                'namespace': BOOTSTRAP_TOKEN_NAMESPACE,
+                'labels': labels or {}
+            },
+            'stringData': {
+                'description': 'Created by the MiCADO security policy manager.',
+                'token-id': token_id,
+                'token-secret': token_secret,
+                'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'usage-bootstrap-authentication': 'true',
+                'usage-bootstrap-signing': 'true',
+                'auth-extra-groups': JOIN_TOKEN_GROUPS
+            }
+        }
+
+        try:
+            api.create_namespaced_secret(BOOTSTRAP_TOKEN_NAMESPACE, secret)
+        except Exception as error:
+            self._logger.error('Failed to create bootstrap token.')
+            self._logger.info(error)
+
+            raise JoinTokenError()
+
+        return self.join_command(token_id + '.' + token_secret)
+
+    def _create_pooled_token(self):
+        return self.create_token(JOIN_TOKEN_POOL_TTL, {JOIN_TOKEN_POOL_LABEL: 'true'})
+
+    def _discard_token(self, join_command):
+        match = COMMAND_TOKEN_PATTERN.search(join_command)
+
+        if match:
+            try:
+                self.delete_token(match.group(1))
+            except JoinTokenNotFoundError:
+                pass
+
+    def delete_token(self, token):
+        '''[summary]
+        Delete a join token
+        [description]
+        Arguments:
+            token -- the token, or its id
+        '''
+        if JOIN_TOKEN_MODE == 'kubeadm':
+            return self._kubeadm('delete', token)
+
+        match = TOKEN_PATTERN.match(token or '')
+
+        if not match:
+            raise JoinTokenNotFoundError()
+
+        try:
+            self._kubernetes_backend.api.delete_namespaced_secret(BOOTSTRAP_TOKEN_PREFIX + match.group(1),
+                                                                  BOOTSTRAP_TOKEN_NAMESPACE)
+        except Exception as error:
+            if getattr(error, 'status', None) == 404:
+                raise JoinTokenNotFoundError()
+
+            self._logger.error('Failed to delete bootstrap token.')
+            self._logger.info(error)
+
+            raise JoinTokenError()
+
+        return 'bootstrap token "%s" deleted\n' % match.group(1)
+
+    def join_command(self, token):
+        return 'kubeadm join %s --token %s --discovery-token-ca-cert-hash sha256:%s\n' % (
+            self._get_join_address(), token, self._get_ca_cert_hash())
+
+    def _get_join_address(self):
+        if self._join_address is None:
+            host = self._kubernetes_backend.api.api_client.configuration.host
+            self._join_address = re.sub(r'^https?://', '', host).rstrip('/')
+
+        return self._join_address
+
+    def _get_ca_cert_hash(self):
+        '''[summary]
+        Hash of the cluster CA's public key, the same as kubeadm prints
+        [description]
+        Read from the CA file of the client configuration, or from the cluster-info
+        ConfigMap if the client has none. Computed once.
+        '''
+        if self._ca_cert_hash is not None:
+            return self._ca_cert_hash
+
+        try:
+            ca_pem = self._read_ca_cert()
+            public_key_info = der.certificate_public_key_info(der.pem_to_der(ca_pem))
+        except Exception as error:
+            self._logger.error('Failed to read Kubernetes CA certificate.')
+            self._logger.info(error)
+
+            raise JoinTokenError()
+
+        self._ca_cert_hash = hashlib.sha256(public_key_info).hexdigest()
+
+        return self._ca_cert_hash
+
+    def _read_ca_cert(self):
+        ca_file = self._kubernetes_backend.api.api_client.configuration.ssl_ca_cert
+
+        if ca_file:
+            with open(ca_file, 'rb') as ca:
+                return ca.read()
+
+        cluster_info = self._kubernetes_backend.api.read_namespaced_config_map('cluster-info', 'kube-public')
+        kubeconfig = yaml.safe_load(cluster_info.data['kubeconfig'])
+
+        return base64.b64decode(kubeconfig['clusters'][0]['cluster']['certificate-authority-data'])
+
+    def _kubeadm(self, *args):
+        try:
+            with timed('kubeadm', args[0]):
+                res = subprocess.run(['kubeadm', 'token'] + list(args), capture_output=True,
+                                     timeout=JOIN_TOKEN_KUBEADM_TIMEOUT)
+        except Exception as error:
+            self._logger.error('Unable to call kubeadm.')
+            self._logger.info(error)
+
+            raise JoinTokenError()
+
+        if res.returncode != 0:
+            self._logger.error('kubeadm token %s failed.', args[0])
+            self._logger.info(res.stderr)
+
+            raise JoinTokenError()
+
+        return res.stdout.decode('utf-8')
@@ -1,8 +1,35 @@
 from enum import Enum
 import logging
 import json
+import os
 from flask import Response
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(payload):
+    return json.dumps(payload).encode('utf-8')
+
+
+def _orjson_dumps(payload):
+    try:
+        return orjson.dumps(payload)
+    except TypeError:
+        # e.g. keys that are not strings, which json converts
+        return _json_dumps(payload)
+
+
+# Encoder of the response payloads, a callable returning bytes; orjson if it is installed
+JSON_RESPONSE_ENCODER = _orjson_dumps if orjson is not None else _json_dumps
+
+# Catalogue of the codes and messages of the responses, next to this module
+JSON_RESPONSE_CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'secretvaultmessages.json')
+
+_logger = logging.getLogger('flask.app')
+
 
 class JsonResponse(Enum):
     VAULT_EXISTS = 'vault_exists'
@@ -23,32 +50,84 @@ class JsonResponse(Enum):
     DELETE_SECRET_FAIL = 'delete_secret_fail'
     DELETE_SECRET_BAD_REQUEST = 'delete_secret_bad_request'
     SECRET_NOT_EXIST = 'secret_not_exist'
+    BATCH_SUCCESS = 'batch_success'
+    BATCH_BAD_REQUEST = 'batch_bad_request'
+    LIST_BAD_REQUEST = 'list_bad_request'
+    NODE_CERTS_BATCH_BAD_REQUEST = 'node_certs_batch_bad_request'
+    CERT_INDEX_RECONCILING = 'cert_index_reconciling'
+    VERSION_BAD_REQUEST = 'version_bad_request'
+    WRITE_SECRET_CONFLICT = 'write_secret_conflict'
+    UNDELETE_SECRET_SUCCESS = 'undelete_secret_success'
+    UNDELETE_SECRET_FAIL = 'undelete_secret_fail'
+    UNDELETE_SECRET_BAD_REQUEST = 'undelete_secret_bad_request'
+    SECRET_NOT_DELETED = 'secret_not_deleted'
+    VAULT_UNAVAILABLE = 'vault_unavailable'
+    SIGN_CSR_BAD_REQUEST = 'sign_csr_bad_request'
+    SIGN_CSR_FAIL = 'sign_csr_fail'
+    NODE_CERTS_REVOKE_BAD_REQUEST = 'node_certs_revoke_bad_request'
+    NODE_CERTS_REVOKE_FAIL = 'node_certs_revoke_fail'
 
     @classmethod
-    def create(cls, message_label, payload={}):
+    def body(cls, message_label, payload=None):
+        '''[summary]
+        Create the body of a json response.
+        [description]
+        Arguments:
+        message_label {[type]} -- [description] Message in the body, loaded from json file.
+        payload {[type]} -- [description] Payload merged into the body, defaults to empty.
+        Returns:
+        dict [type] -- [description] code, message and payload
+        '''
+        data = dict(message_label._body)
+        if payload:
+            data.update(payload)
+
+        return data
+
+    @classmethod
+    def create(cls, message_label, payload=None):
         '''[summary]
         Create a json object to respond a http request.
         [description]
+        The code and message of every response are rendered once when the module is loaded,
+        only the payload is encoded per response, with JSON_RESPONSE_ENCODER.
         Arguments:
         message_label {[type]} -- [description] Message in the HTTP response body, loaded from json file.
         payload {[type]} -- [description] Payload in the json response, defaults to empty.
         Returns:
         Response [type] -- [description] HTTP response object
         '''
-        logger = logging.getLogger('flask.app')
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug('Creating json response with HTTP status %s, message "%s" and payload %s',
+                          message_label._status, message_label._body['message'], payload)
+
+        if not payload:
+            js = message_label._rendered
+        elif 'code' in payload or 'message' in payload:
+            js = JSON_RESPONSE_ENCODER(cls.body(message_label, payload))
+        else:
+            encoded = JSON_RESPONSE_ENCODER(payload)
+            # '{"code":..,"message":".."' + ',' + '"key":..}'
+            js = message_label._prefix + b',' + encoded[1:]
+
+        return Response(js, status=message_label._status, content_type='application/json')
+
+
+def _load_catalogue(path):
+    with open(path, 'r', encoding='utf-8') as messagefile:
+        JsonResponse._msg_dict = json.load(messagefile)
 
-        logger.debug(f'Creating json response with HTTP status {cls._msg_dict[message_label.value][0]}, '
-                     f'message "{cls._msg_dict[message_label.value][1]}" and payload {payload}')
+    for member in JsonResponse:
+        # members without a message in the catalogue are not used
+        if member.value not in JsonResponse._msg_dict:
+            continue
 
-        data = {
-            'code': cls._msg_dict[message_label.value][0],
-            'message': cls._msg_dict[message_label.value][1]
-        }
-        data.update(payload)
-        js = json.dumps(data)
+        code, message = JsonResponse._msg_dict[member.value]
 
-        return Response(js, status=cls._msg_dict[message_label.value][0], mimetype='application/json')
+        member._status = code
+        member._body = {'code': code, 'message': message}
+        member._rendered = JSON_RESPONSE_ENCODER(member._body)
+        member._prefix = member._rendered[:-1]
 
 
-with open('lib/secretvaultmessages.json', 'r', encoding='utf-8') as messagefile:
-    JsonResponse._msg_dict = json.load(messagefile)
+_load_catalogue(JSON_RESPONSE_CATALOGUE)
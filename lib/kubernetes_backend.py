@@ -1,6 +1,65 @@
 import logging
 import base64
-from kubernetes import client, config
+import bisect
+import hashlib
+import threading
+import time
+from lib.metrics import TimedProxy
+from lib.resilience import GuardedProxy, get_breaker
+from lib.single_flight import get_single_flight
+
+
+# the kubernetes client is slow to import, it is imported when the backend is initialized
+client = None
+config = None
+watch = None
+ApiException = None
+
+
+def _import_kubernetes():
+    global client, config, watch, ApiException
+
+    if client is None:
+        from kubernetes import client, config, watch
+        from kubernetes.client.rest import ApiException
+
+
+# Name and namespace of the Kubernetes secret holding application secrets
+APP_SECRET_NAME = 'micado.appsecret'
+APP_SECRET_NAMESPACE = 'default'
+
+# Layout of the application secrets: 'single' keeps every key in APP_SECRET_NAME,
+# 'sharded' spreads the keys over APP_SECRET_SHARDS secrets by consistent hashing
+APP_SECRET_STORAGE = 'single'
+
+# Number of secrets the keys are spread over in sharded mode
+APP_SECRET_SHARDS = 16
+
+# Label selecting the shards of the application secret
+APP_SECRET_SHARD_LABEL = 'app.micado/appsecret'
+APP_SECRET_SHARD_LABEL_VALUE = 'shard'
+
+# Points per shard on the consistent hash ring
+APP_SECRET_HASH_REPLICAS = 64
+
+# Seconds a cached copy of the application secret is served without asking the API server
+APP_SECRET_CACHE_TTL = 5
+
+# Keep the cached copy up to date by watching the secret instead of expiring it
+APP_SECRET_CACHE_WATCH = False
+
+# Seconds to wait before re-establishing a failed watch
+APP_SECRET_WATCH_BACKOFF = 5
+
+# Seconds the first write of a batch waits for concurrent writes to join it
+APP_SECRET_WRITE_WINDOW = 0.01
+
+# Attempts to apply a batch of writes when the secret is modified concurrently
+APP_SECRET_WRITE_RETRIES = 5
+
+# Seconds to wait for a connection to the API server and for its response
+KUBERNETES_CONNECT_TIMEOUT = 3.05
+KUBERNETES_READ_TIMEOUT = 10
 
 
 class KubernetesBackendError(Exception):
@@ -11,89 +70,533 @@ class KubernetesBackendKeyNotFoundError(Exception):
     pass
 
 
+class _SecretCache:
+    '''[summary]
+    In-memory copies of Kubernetes secret objects
+    [description]
+    Entries expire after the TTL, unless a watch keeps them current. Cached objects
+    are shared between threads and must not be modified by readers.
+    '''
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.watching = False
+
+    def get(self, name):
+        entry = self._entries.get(name)
+
+        if entry is None:
+            return None
+
+        secret, fetched_at = entry
+
+        if self.watching or time.monotonic() - fetched_at < self._ttl:
+            return secret
+
+        return None
+
+    def put(self, secret):
+        with self._lock:
+            self._entries[secret.metadata.name] = (secret, time.monotonic())
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+class _HashRing:
+    '''[summary]
+    Consistent hash ring
+    [description]
+    Maps keys to nodes so that changing the number of nodes moves only a small
+    fraction of the keys.
+    '''
+
+    def __init__(self, nodes, replicas):
+        self._ring = sorted((self._hash('%s#%d' % (node, replica)), node)
+                            for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('UTF-8')).digest()[:8], 'big')
+
+    def get(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+
+        return self._ring[index][1]
+
+
+class _PendingWrite:
+    __slots__ = ('op', 'name', 'value', 'error', 'lead', 'done')
+
+    def __init__(self, op, name, value):
+        self.op = op
+        self.name = name
+        self.value = value
+        self.error = None
+        self.lead = False
+        self.done = threading.Event()
+
+
+class _SecretWriteBatcher:
+    '''[summary]
+    Coalesces concurrent writes to the application secret
+    [description]
+    The first writer waits a short window, then applies every write queued meanwhile
+    as a single patch. Writes queued while a batch is being applied are handed to the
+    next leader, so each caller waits for at most one batch besides its own.
+    '''
+
+    def __init__(self, apply, window):
+        self._apply = apply
+        self._window = window
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flushing = False
+
+    def submit(self, op, name, value=None):
+        write = _PendingWrite(op, name, value)
+
+        with self._lock:
+            self._pending.append(write)
+
+            if not self._flushing:
+                self._flushing = True
+                write.lead = True
+
+        if write.lead:
+            time.sleep(self._window)
+        else:
+            write.done.wait()
+
+        # promoted to leader by the previous batch
+        if write.lead:
+            self._flush()
+
+        if write.error is not None:
+            raise write.error
+
+    def _flush(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+
+        try:
+            self._apply(batch)
+        except Exception as error:
+            for write in batch:
+                if write.error is None:
+                    write.error = error
+
+        with self._lock:
+            if self._pending:
+                self._pending[0].lead = True
+                self._pending[0].done.set()
+            else:
+                self._flushing = False
+
+        for write in batch:
+            write.lead = False
+            write.done.set()
+
+
 class KubernetesBackend:
     # The Borg Singleton
     __shared_state = {}
 
     _api = None
 
+    _initialized = False
+
+    _init_lock = threading.Lock()
+
     def __init__(self):
 
         # The Borg Singleton
         self.__dict__ = self.__shared_state
 
-        if not self._api:
-            self._logger = logging.getLogger('flask.app')
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    self._init()
 
-            self._logger.info('Initializing Kubernetes Client.')
+    def _init(self):
+        _import_kubernetes()
 
-            config.load_kube_config()
+        self._logger = logging.getLogger('flask.app')
 
-            self._api = client.CoreV1Api()
+        self._logger.info('Initializing Kubernetes Client.')
 
-            if self._is_secret_initialized():
-                self._logger.info('K8S Secret already initalized.')
-            else:
-                self._logger.info('Initializing K8S Secret.')
+        config.load_kube_config()
+
+        # the watch streams from the client itself, without timeout and breaker
+        self._core_api = client.CoreV1Api()
+
+        breaker = get_breaker('kubernetes', failure=lambda error: (getattr(error, 'status', None) or 500) >= 500)
+
+        self._api = TimedProxy(GuardedProxy(self._core_api, breaker,
+                                            _request_timeout=(KUBERNETES_CONNECT_TIMEOUT, KUBERNETES_READ_TIMEOUT)),
+                               'kubernetes')
 
-                self._init_secret()
+        self._cache = _SecretCache(APP_SECRET_CACHE_TTL)
+        self._reads = get_single_flight('kubernetes')
 
-                self._logger.info('K8S Secret initalized.')
+        self._writers = {}
+        self._writers_lock = threading.Lock()
 
-    def _is_secret_initialized(self):
+        if APP_SECRET_STORAGE == 'sharded':
+            self._shards = ['%s-%02d' % (APP_SECRET_NAME, shard) for shard in range(APP_SECRET_SHARDS)]
+            self._shard_selector = APP_SECRET_SHARD_LABEL + '=' + APP_SECRET_SHARD_LABEL_VALUE
+            self._ring = _HashRing(self._shards, APP_SECRET_HASH_REPLICAS)
+
+            self._migrate_to_shards(self._init_shards())
+        elif self._is_secret_initialized():
+            self._logger.info('K8S Secret already initalized.')
+        else:
+            self._logger.info('Initializing K8S Secret.')
+
+            self._init_secret(APP_SECRET_NAME)
+
+            self._logger.info('K8S Secret initalized.')
+
+        if APP_SECRET_CACHE_WATCH:
+            self._start_watch()
+
+        self._initialized = True
+
+    @property
+    def api(self):
+        '''[summary]
+        The CoreV1Api client shared by the Kubernetes backends
+        '''
+        return self._api
+
+    def _start_watch(self):
+        self._watcher = threading.Thread(target=self._watch_secret, name='appsecret-watch', daemon=True)
+        self._watcher.start()
+
+    def after_fork(self):
+        '''[summary]
+        Prepare a backend initialized by the parent process for use in a forked child
+        [description]
+        Drops the inherited connections and cache and restarts the watch, threads do not
+        survive a fork.
+        '''
+        self._api.api_client.rest_client.pool_manager.clear()
+
+        self._cache.watching = False
+        self._cache.invalidate()
+
+        if APP_SECRET_CACHE_WATCH:
+            self._start_watch()
+
+    def _is_secret_initialized(self, object_name=APP_SECRET_NAME):
         try:
-            self._get_secret()
+            self._get_secret(object_name)
         except KubernetesBackendError:
             return False
 
         return True
 
-    def _init_secret(self):
+    def _init_secret(self, object_name, labels=None):
         secret = client.V1Secret()
         secret.api_version = 'v1'
         secret.metadata = client.V1ObjectMeta()
-        secret.metadata.name = 'micado.appsecret'
+        secret.metadata.name = object_name
+        secret.metadata.labels = labels
 
         try:
-            api_response = self._api.create_namespaced_secret('default', secret)
+            api_response = self._api.create_namespaced_secret(APP_SECRET_NAMESPACE, secret)
+        except ApiException as error:
+            if error.status != 409:
+                self._logger.error('Failed to initialize K8S Secret.')
+                self._logger.info(error)
+
+                raise KubernetesBackendError()
+
+            # created by another replica or worker starting at the same time
+            self._logger.info('K8S Secret %s already initalized.', object_name)
+
+            return
         except Exception as error:
             self._logger.error('Failed to initialize K8S Secret.')
             self._logger.info(error)
 
             raise KubernetesBackendError()
 
-    def _get_secret(self):
+        self._cache_secret(api_response)
+
+    def _init_shards(self):
+        shards = self._list_shards()
+
+        existing = set(secret.metadata.name for secret in shards)
+
+        missing = [shard for shard in self._shards if shard not in existing]
+
+        if not missing:
+            self._logger.info('K8S Secret shards already initalized.')
+            return shards
+
+        self._logger.info('Initializing %s K8S Secret shards.', len(missing))
+
+        for shard in missing:
+            self._init_secret(shard, {APP_SECRET_SHARD_LABEL: APP_SECRET_SHARD_LABEL_VALUE})
+
+        self._logger.info('K8S Secret shards initalized.')
+
+        return shards
+
+    def _migrate_to_shards(self, shards):
+        '''[summary]
+        Move keys into the shard they belong to
+        [description]
+        Moves every key of the single secret, and every key left in the wrong shard after
+        APP_SECRET_SHARDS was changed. Keys are copied without overwriting keys already
+        stored in the target shard, then removed from the source. The single secret itself
+        is kept, so this is safe to run on every start.
+        '''
+        try:
+            sources = [self._api.read_namespaced_secret(APP_SECRET_NAME, APP_SECRET_NAMESPACE)]
+        except ApiException as error:
+            if error.status != 404:
+                self._logger.error('Failed to read K8S Secret for migration.')
+                self._logger.info(error)
+
+                raise KubernetesBackendError()
+
+            sources = []
+
+        sources.extend(shards)
+
+        for source in sources:
+            misplaced = [name for name in (source.data or {}) if self._ring.get(name) != source.metadata.name]
+
+            if not misplaced:
+                continue
+
+            self._logger.info('Migrating %s keys from K8S Secret %s into shards.', len(misplaced), source.metadata.name)
+
+            by_shard = {}
+            for name in misplaced:
+                by_shard.setdefault(self._ring.get(name), []).append(name)
+
+            for shard, names in by_shard.items():
+                self._apply_writes(shard, [_PendingWrite('migrate', name, source.data[name]) for name in names])
+
+            self._apply_writes(source.metadata.name, [_PendingWrite('delete', name, None) for name in misplaced])
+
+    def _list_shards(self):
         try:
-            secret = self._api.read_namespaced_secret('micado.appsecret', 'default')
+            secrets = self._api.list_namespaced_secret(APP_SECRET_NAMESPACE, label_selector=self._shard_selector)
         except Exception as error:
-            self._logger.error('Failed to read K8S Secret.')
+            self._logger.error('Failed to list K8S Secret shards.')
             self._logger.info(error)
 
             raise KubernetesBackendError()
 
+        for secret in secrets.items:
+            self._cache_secret(secret)
+
+        return secrets.items
+
+    def _get_shards(self):
+        '''[summary]
+        Read the shard objects
+        [description]
+        Served from the cache when every shard is cached, otherwise one list call, shared
+        by concurrent misses, reads and caches all of them. The returned objects are
+        shared and must not be modified.
+        '''
+        shards = [self._cache.get(shard) for shard in self._shards]
+
+        if None not in shards:
+            return shards
+
+        return self._reads.do(self._shard_selector, self._list_shards)
+
+    def _forget(self, object_name):
+        self._reads.forget(object_name)
+
+        if APP_SECRET_STORAGE == 'sharded':
+            self._reads.forget(self._shard_selector)
+
+    def _object_for(self, name):
+        if APP_SECRET_STORAGE == 'sharded':
+            return self._ring.get(name)
+
+        return APP_SECRET_NAME
+
+    def _watch_secret(self):
+        '''[summary]
+        Keep the cached secrets current
+        [description]
+        Runs in a background thread. While the watch is established cached entries do not
+        expire; if it breaks the cache falls back to TTL expiry until it is re-established.
+        '''
+        if APP_SECRET_STORAGE == 'sharded':
+            selector = {'label_selector': APP_SECRET_SHARD_LABEL + '=' + APP_SECRET_SHARD_LABEL_VALUE}
+        else:
+            selector = {'field_selector': 'metadata.name=' + APP_SECRET_NAME}
+
+        while True:
+            try:
+                stream = watch.Watch().stream(self._core_api.list_namespaced_secret, APP_SECRET_NAMESPACE,
+                                              **selector)
+
+                for event in stream:
+                    if event['type'] == 'DELETED':
+                        self._cache.invalidate(event['object'].metadata.name)
+                    elif event['type'] in ('ADDED', 'MODIFIED'):
+                        self._cache_secret(event['object'])
+                        self._cache.watching = True
+            except Exception as error:
+                self._logger.error('Watch on K8S Secret failed.')
+                self._logger.info(error)
+
+            self._cache.watching = False
+            self._cache.invalidate()
+
+            time.sleep(APP_SECRET_WATCH_BACKOFF)
+
+    def _cache_secret(self, secret):
+        if secret is None or secret.metadata is None:
+            return
+
         if secret.data is None:
             secret.data = {}
 
-        return secret
+        self._cache.put(secret)
 
-    def _put_secret(self, secret):
+    def _get_secret(self, object_name=APP_SECRET_NAME):
+        '''[summary]
+        Read a secret object
+        [description]
+        Served from the cache when possible, concurrent misses share one read. The
+        returned object is shared and must not be modified.
+        '''
+        secret = self._cache.get(object_name)
+
+        if secret is not None:
+            return secret
+
+        return self._reads.do(object_name, self._read_secret, object_name)
+
+    def _read_secret(self, object_name):
         try:
-            self._api.replace_namespaced_secret('micado.appsecret', 'default', secret)
+            secret = self._api.read_namespaced_secret(object_name, APP_SECRET_NAMESPACE)
         except Exception as error:
-            self._logger.error('Failed to update K8S Secret.')
+            self._logger.error('Failed to read K8S Secret.')
             self._logger.info(error)
 
             raise KubernetesBackendError()
 
-    def create_secret(self, name, value):
-        secret = self._get_secret()
+        self._cache_secret(secret)
 
-        secret.data[name] = base64.b64encode(value.encode('UTF-8')).decode('ASCII')
+        return secret
 
-        self._put_secret(secret)
+    @staticmethod
+    def _encode(value):
+        return base64.b64encode(value.encode('UTF-8')).decode('ASCII')
+
+    def _writer(self, object_name):
+        writer = self._writers.get(object_name)
+
+        if writer is None:
+            with self._writers_lock:
+                writer = self._writers.get(object_name)
+                if writer is None:
+                    writer = _SecretWriteBatcher(lambda writes: self._apply_writes(object_name, writes),
+                                                 APP_SECRET_WRITE_WINDOW)
+                    self._writers[object_name] = writer
+
+        return writer
+
+    def _apply_writes(self, object_name, writes):
+        '''[summary]
+        Apply a batch of writes with a single patch
+        [description]
+        The writes are validated in order against the current secret and sent as one
+        strategic merge patch guarded by the resourceVersion. On a conflict the secret
+        is re-read and the batch is validated and sent again. Validation failures are
+        recorded on the individual writes.
+        '''
+        for attempt in range(APP_SECRET_WRITE_RETRIES):
+            secret = self._get_secret(object_name)
+
+            keys = set(secret.data)
+            data = {}
+
+            for write in writes:
+                write.error = None
+
+                if write.op == 'update' and write.name not in keys:
+                    write.error = KubernetesBackendKeyNotFoundError()
+                elif write.op == 'delete':
+                    if write.name in keys:
+                        keys.discard(write.name)
+                        data[write.name] = None
+                elif write.op == 'migrate':
+                    # already encoded, never overwrites a newer value
+                    if write.name not in keys:
+                        keys.add(write.name)
+                        data[write.name] = write.value
+                else:
+                    keys.add(write.name)
+                    data[write.name] = self._encode(write.value)
+
+            if not data:
+                return
+
+            body = {
+                'metadata': {'resourceVersion': secret.metadata.resource_version},
+                'data': data
+            }
+
+            try:
+                api_response = self._api.patch_namespaced_secret(object_name, APP_SECRET_NAMESPACE, body)
+            except ApiException as error:
+                self._cache.invalidate(object_name)
+                self._forget(object_name)
+
+                if error.status == 409:
+                    self._logger.info('K8S Secret modified concurrently, retrying update.')
+                    continue
+
+                self._logger.error('Failed to update K8S Secret.')
+                self._logger.info(error)
+
+                raise KubernetesBackendError()
+            except Exception as error:
+                self._cache.invalidate(object_name)
+                self._forget(object_name)
+
+                self._logger.error('Failed to update K8S Secret.')
+                self._logger.info(error)
+
+                raise KubernetesBackendError()
+
+            self._cache_secret(api_response)
+
+            # reads in flight may have started before the patch
+            self._forget(object_name)
+
+            return
+
+        self._logger.error('Failed to update K8S Secret, too many conflicting updates.')
+
+        raise KubernetesBackendError()
+
+    def create_secret(self, name, value):
+        self._writer(self._object_for(name)).submit('create', name, value)
 
     def read_secret(self, name):
-        secret = self._get_secret()
+        secret = self._get_secret(self._object_for(name))
 
         if name not in secret.data:
             raise KubernetesBackendKeyNotFoundError
@@ -101,26 +604,15 @@ class KubernetesBackend:
         return base64.b64decode(secret.data[name])
 
     def list_secrets(self):
-        secret = self._get_secret()
+        if APP_SECRET_STORAGE == 'sharded':
+            return [name for secret in self._get_shards() for name in secret.data]
 
-        return secret.data.keys()
-
-    def update_secret(self, name, value):
         secret = self._get_secret()
 
-        if name not in secret.data:
-            raise KubernetesBackendKeyNotFoundError
-
-        secret.data[name] = base64.b64encode(value.encode('UTF-8')).decode('ASCII')
+        return list(secret.data.keys())
 
-        self._put_secret(secret)
+    def update_secret(self, name, value):
+        self._writer(self._object_for(name)).submit('update', name, value)
 
     def delete_secret(self, name):
-        secret = self._get_secret()
-
-        try:
-            del secret.data[name]
-        except KeyError:
-            pass
-
-        self._put_secret(secret)
+        self._writer(self._object_for(name)).submit('delete', name)
@@ -0,0 +1,116 @@
+'''[summary]
+Metrics module
+[description]
+Prometheus metrics of the API and of the calls to its backends. With several gunicorn
+workers the environment variable prometheus_multiproc_dir must point to an empty
+directory (see bin/spm-serve), the metrics of all workers are then exported together.
+'''
+import functools
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+
+
+# Upper bounds in seconds of the latency histogram buckets
+METRICS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUESTS = Counter('spm_http_requests_total', 'HTTP requests handled',
+                        ['endpoint', 'method', 'status'])
+
+HTTP_REQUEST_DURATION = Histogram('spm_http_request_duration_seconds', 'Time to the HTTP response headers',
+                                  ['endpoint', 'method'], buckets=METRICS_BUCKETS)
+
+BACKEND_REQUEST_DURATION = Histogram('spm_backend_request_duration_seconds', 'Duration of backend calls',
+                                     ['backend', 'operation'], buckets=METRICS_BUCKETS)
+
+BACKEND_ERRORS = Counter('spm_backend_errors_total', 'Backend calls that raised',
+                         ['backend', 'operation'])
+
+
+@contextmanager
+def timed(backend, operation):
+    '''[summary]
+    Time a backend call
+    [description]
+    with timed('vault_kv', 'read'):
+        ...
+    '''
+    started = time.perf_counter()
+
+    try:
+        yield
+    except Exception:
+        BACKEND_ERRORS.labels(backend, operation).inc()
+        raise
+    finally:
+        BACKEND_REQUEST_DURATION.labels(backend, operation).observe(time.perf_counter() - started)
+
+
+class TimedProxy:
+    '''[summary]
+    Proxy timing every public method called on an API client
+    [description]
+    The method name is used as operation, attributes are passed through.
+    '''
+
+    def __init__(self, target, backend):
+        self._target = target
+        self._backend = backend
+        self._methods = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        method = self._methods.get(name)
+
+        if method is None:
+            @functools.wraps(attribute)
+            def method(*args, **kwargs):
+                with timed(self._backend, name):
+                    return getattr(self._target, name)(*args, **kwargs)
+
+            self._methods[name] = method
+
+        return method
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+
+    if started is not None:
+        endpoint = request.endpoint or 'unknown'
+
+        HTTP_REQUEST_DURATION.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        HTTP_REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+
+    return response
+
+
+def init_app(app):
+    '''[summary]
+    Count and time every request of the Flask app
+    '''
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def export():
+    '''[summary]
+    Metrics in the Prometheus text format
+    '''
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry)
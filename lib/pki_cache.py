@@ -0,0 +1,166 @@
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from flask import request, Response
+from lib import der
+from lib.vault_backend import VaultPkiBackend
+
+
+# Seconds the CA certificate is cached, here and by clients
+PKI_CA_MAX_AGE = 3600
+
+# Upper bound of seconds the CRL is cached, less if its nextUpdate is closer
+PKI_CRL_MAX_AGE = 300
+
+# Lower bound of seconds the CRL is cached, even if it is past its nextUpdate
+PKI_CRL_MIN_AGE = 10
+
+# File whose modification time tells every worker that the cached CA and CRL are stale,
+# touched on invalidation, e.g. after a revocation
+PKI_CACHE_STAMP_FILE = 'pkicache.stamp'
+
+PKI_CACHE_PATHS = {
+    'ca': '/v1/pki/ca/pem',
+    'crl': '/v1/pki/crl/pem'
+}
+
+
+class PkiCacheEntry:
+    def __init__(self, body, etag, last_modified, max_age, stamp=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = time.monotonic() + max_age
+        self.stamp = stamp
+
+    def max_age(self):
+        return max(int(self.expires_at - time.monotonic()), 0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def response(self):
+        '''[summary]
+        Create a conditional response for the current request
+        [description]
+        Answers 304 Not Modified when the client's If-None-Match or If-Modified-Since
+        matches the cached entry.
+        '''
+        resp = Response(self.body, 200)
+        resp.set_etag(self.etag)
+        resp.last_modified = self.last_modified
+        resp.cache_control.public = True
+        resp.cache_control.max_age = self.max_age()
+
+        return resp.make_conditional(request)
+
+
+class PkiCache:
+    '''[summary]
+    Cache of the CA certificate and the CRL of the Vault PKI
+    [description]
+    Every IPsec peer polls these, so they are fetched from Vault once per max age and
+    served from memory with validators for conditional requests. Revoking a certificate
+    must invalidate the CRL; the invalidation reaches the other workers through the
+    modification time of PKI_CACHE_STAMP_FILE, checked on every get.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _entries = None
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+        if self._entries is None:
+            self._logger = logging.getLogger('flask.app')
+            self._vault_backend = VaultPkiBackend()
+            self._lock = threading.Lock()
+            self._entries = {}
+
+    def get(self, name):
+        '''[summary]
+        Get the CA certificate ('ca') or the CRL ('crl')
+        [description]
+        Returns:
+            [type] tuple -- [description] the cache entry, or None and the Vault response if Vault did not return 200
+        '''
+        entry = self._entries.get(name)
+        stamp = self._stamp()
+
+        if entry is not None and not entry.expired() and entry.stamp == stamp:
+            return entry, None
+
+        resp = self._vault_backend.getAnonymous(PKI_CACHE_PATHS[name])
+
+        if resp.status_code != 200:
+            return None, resp
+
+        entry = self._create_entry(name, resp.content)
+        # read before the fetch, an invalidation meanwhile makes the next get fetch again
+        entry.stamp = stamp
+
+        with self._lock:
+            self._entries[name] = entry
+
+        return entry, None
+
+    def _create_entry(self, name, body):
+        etag = hashlib.sha256(body).hexdigest()
+        last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+        if name == 'ca':
+            # the same in every worker, unlike the time of the fetch
+            try:
+                last_modified = der.certificate_info(der.pem_to_der(body, 'CERTIFICATE'))['not_before']
+            except der.DerError as error:
+                self._logger.info('Unable to parse CA certificate.')
+                self._logger.debug(error)
+
+            return PkiCacheEntry(body, etag, last_modified, PKI_CA_MAX_AGE)
+
+        max_age = PKI_CRL_MAX_AGE
+
+        try:
+            crl = der.parse_crl(der.pem_to_der(body))
+        except der.DerError as error:
+            self._logger.info('Unable to parse CRL, caching it for %s seconds.', max_age)
+            self._logger.debug(error)
+        else:
+            last_modified = crl['this_update']
+
+            if crl['next_update'] is not None:
+                until_next_update = (crl['next_update'] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                max_age = max(min(max_age, int(until_next_update)), PKI_CRL_MIN_AGE)
+
+        return PkiCacheEntry(body, etag, last_modified, max_age)
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+        # a read in flight may have started before the change
+        self._vault_backend.forget(PKI_CACHE_PATHS[name] if name is not None else None)
+
+        # and the other workers still cache what they read before
+        try:
+            with open(PKI_CACHE_STAMP_FILE, 'a'):
+                pass
+            os.utime(PKI_CACHE_STAMP_FILE)
+        except OSError as error:
+            self._logger.error('Unable to signal the invalidation of the PKI cache to the other workers.')
+            self._logger.info(error)
+
+    @staticmethod
+    def _stamp():
+        try:
+            return os.stat(PKI_CACHE_STAMP_FILE).st_mtime_ns
+        except OSError:
+            return None
@@ -0,0 +1,326 @@
+import collections
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Number of most recent calls the failure rate of a circuit breaker is computed over
+BREAKER_WINDOW = 20
+
+# Minimum number of calls in the window before a circuit breaker opens
+BREAKER_MIN_CALLS = 10
+
+# Fraction of failed or slow calls in the window that opens a circuit breaker
+BREAKER_FAILURE_RATE = 0.5
+
+# Seconds after which a call counts as slow, like a failure
+BREAKER_SLOW_CALL = 5
+
+# Seconds an open circuit breaker rejects calls before it lets a trial call through
+BREAKER_OPEN_TIME = 30
+
+# Seconds to wait for a hedged read before sending it a second time: the 95th percentile
+# of its recent latencies, within these bounds
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 1
+
+# Number of recent latencies the hedge delay is computed from
+HEDGE_WINDOW = 100
+
+# Threads per worker running hedged reads
+HEDGE_WORKERS = 16
+
+
+class CircuitBreakerOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    '''[summary]
+    Circuit breaker of a backend
+    [description]
+    Closed, calls pass through and their outcome is recorded. When at least
+    BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls failed or took longer than
+    slow_call seconds, the breaker opens and calls fail at once with
+    CircuitBreakerOpenError. After BREAKER_OPEN_TIME seconds a single trial call is let
+    through (half open), its outcome closes or opens the breaker again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure=None, failed_result=None, slow_call=BREAKER_SLOW_CALL):
+        '''[summary]
+        Arguments:
+            failure -- callable telling if an exception counts as failure, all do by default
+            failed_result -- callable telling if a result counts as failure, e.g. a 5xx response
+            slow_call -- seconds after which a call counts as failure
+        '''
+        self.name = name
+        self._failure = failure
+        self._failed_result = failed_result
+        self._slow_call = slow_call
+
+        self._logger = logging.getLogger('flask.app')
+        self._lock = threading.Lock()
+        self._window = collections.deque(maxlen=BREAKER_WINDOW)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trial = False
+        self._calls = 0
+        self._failures = 0
+        self._slow_calls = 0
+        self._rejected = 0
+        self._opened = 0
+
+    def call(self, func, *args, **kwargs):
+        '''[summary]
+        Call func through the breaker
+        [description]
+        Raises:
+            CircuitBreakerOpenError -- the breaker is open
+        '''
+        self._before()
+
+        started = time.monotonic()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self._after(self._failure is None or self._failure(error), time.monotonic() - started)
+            raise
+
+        self._after(self._failed_result is not None and self._failed_result(result), time.monotonic() - started)
+
+        return result
+
+    def _before(self):
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < BREAKER_OPEN_TIME:
+                    self._rejected += 1
+                    raise CircuitBreakerOpenError(self.name)
+
+                self._state = self.HALF_OPEN
+                self._trial = False
+
+            if self._state == self.HALF_OPEN:
+                # only one trial call at a time
+                if self._trial:
+                    self._rejected += 1
+                    raise CircuitBreakerOpenError(self.name)
+
+                self._trial = True
+
+    def _after(self, failed, duration):
+        slow = duration > self._slow_call
+
+        with self._lock:
+            self._calls += 1
+            self._failures += failed
+            self._slow_calls += slow
+
+            if self._state == self.HALF_OPEN:
+                self._trial = False
+
+                if failed or slow:
+                    self._open()
+                else:
+                    self._logger.info('Circuit breaker %s closed.', self.name)
+                    self._state = self.CLOSED
+                    self._window.clear()
+
+                return
+
+            self._window.append(failed or slow)
+
+            if (self._state == self.CLOSED and len(self._window) >= BREAKER_MIN_CALLS
+                    and sum(self._window) >= BREAKER_FAILURE_RATE * len(self._window)):
+                self._open()
+
+    def _open(self):
+        self._logger.error('Circuit breaker %s open, failing calls for %s seconds.', self.name, BREAKER_OPEN_TIME)
+
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._opened += 1
+
+    def stats(self):
+        return {
+            'state': self._state,
+            'failure_rate': sum(self._window) / len(self._window) if self._window else 0.0,
+            'calls': self._calls,
+            'failures': self._failures,
+            'slow_calls': self._slow_calls,
+            'rejected': self._rejected,
+            'opened': self._opened
+        }
+
+
+_executor = None
+
+_executor_pid = None
+
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    # threads do not survive a fork, every worker needs its own
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+                _executor_pid = os.getpid()
+
+    return _executor
+
+
+class Hedge:
+    '''[summary]
+    Hedged idempotent reads
+    [description]
+    If a read has not completed after the 95th percentile of the recent latencies, it is
+    sent a second time and the first result is used, cutting the tail latency caused by
+    a slow connection or a stalled backend instance. Only for reads without side effects.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=HEDGE_WINDOW)
+        self._calls = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+
+    def delay(self):
+        latencies = sorted(self._latencies)
+
+        if not latencies:
+            return HEDGE_MAX_DELAY
+
+        return min(max(latencies[int(len(latencies) * 0.95)], HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def call(self, func, *args, **kwargs):
+        executor = _get_executor()
+
+        started = time.monotonic()
+
+        first = executor.submit(func, *args, **kwargs)
+        done, _ = wait([first], timeout=self.delay())
+
+        future = first
+
+        if not done:
+            second = executor.submit(func, *args, **kwargs)
+
+            with self._lock:
+                self._hedged += 1
+
+            done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+            future = done.pop()
+
+            # the other attempt may still succeed
+            if future.exception() is not None:
+                future = second if future is first else first
+
+            if future is second:
+                with self._lock:
+                    self._hedge_wins += 1
+
+        result = future.result()
+
+        with self._lock:
+            self._calls += 1
+            self._latencies.append(time.monotonic() - started)
+
+        return result
+
+    def stats(self):
+        return {
+            'calls': self._calls,
+            'hedged': self._hedged,
+            'hedge_wins': self._hedge_wins,
+            'delay': self.delay()
+        }
+
+
+class GuardedProxy:
+    '''[summary]
+    Proxy passing every public method called on an API client through a circuit breaker
+    [description]
+    The keyword arguments given to the proxy, e.g. a timeout, are added to every call.
+    Attributes are passed through.
+    '''
+
+    def __init__(self, target, breaker, **kwargs):
+        self._target = target
+        self._breaker = breaker
+        self._kwargs = kwargs
+        self._methods = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        method = self._methods.get(name)
+
+        if method is None:
+            def method(*args, **kwargs):
+                for key, value in self._kwargs.items():
+                    kwargs.setdefault(key, value)
+
+                return self._breaker.call(getattr(self._target, name), *args, **kwargs)
+
+            self._methods[name] = method
+
+        return method
+
+
+_breakers = {}
+
+_hedges = {}
+
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name, **kwargs):
+    '''[summary]
+    Get the circuit breaker with the given name
+    [description]
+    The breaker is created with the given settings on first use and shared afterwards.
+    '''
+    breaker = _breakers.get(name)
+
+    if breaker is None:
+        with _registry_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, **kwargs)
+                _breakers[name] = breaker
+
+    return breaker
+
+
+def get_hedge(name):
+    hedge = _hedges.get(name)
+
+    if hedge is None:
+        with _registry_lock:
+            hedge = _hedges.setdefault(name, Hedge(name))
+
+    return hedge
+
+
+def breaker_stats():
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
+
+
+def hedge_stats():
+    return {name: hedge.stats() for name, hedge in list(_hedges.items())}
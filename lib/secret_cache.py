@@ -0,0 +1,156 @@
+import collections
+import json
+import threading
+import time
+from hvac import exceptions
+from lib.single_flight import get_single_flight
+
+
+# Cache secrets read from Vault KV in memory
+SECRET_CACHE_ENABLED = False
+
+# Maximum number of secrets cached per worker, the least recently used are evicted
+SECRET_CACHE_SIZE = 1024
+
+# Seconds a secret is served from the cache
+SECRET_CACHE_TTL = 30
+
+# Seconds a secret that does not exist is remembered as such
+SECRET_CACHE_NEGATIVE_TTL = 5
+
+
+def _zeroize(buffer):
+    if buffer is not None:
+        buffer[:] = bytes(len(buffer))
+
+
+class SecretCache:
+    '''[summary]
+    Read-through LRU cache of Vault KV secrets
+    [description]
+    Secrets are held in bytearrays that are overwritten with zeros when they are evicted,
+    expire or are invalidated; the copies handed to the caller are ordinary objects.
+    Secrets missing in Vault are cached for SECRET_CACHE_NEGATIVE_TTL seconds. Writes and
+    deletes through SPM invalidate the secret at once in the worker handling them; other
+    workers serve their copy for at most SECRET_CACHE_TTL seconds. Concurrent misses of a
+    secret, with the cache enabled or not, are loaded from Vault once.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _entries = None
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+        if self._entries is None:
+            self._lock = threading.Lock()
+            self._generation = 0
+            self._hits = 0
+            self._negative_hits = 0
+            self._misses = 0
+            self._evictions = 0
+            self._expirations = 0
+            self._flight = get_single_flight('vault_kv')
+            self._entries = collections.OrderedDict()
+
+    def read(self, name, load):
+        '''[summary]
+        Read a secret through the cache
+        [description]
+        Arguments:
+            name -- name of the secret
+            load -- callable reading the secret from Vault on a miss, e.g. VaultBackend().read_secret
+
+        Returns:
+            [type] dict -- [description] the secret in the format of the hvac client
+
+        Raises:
+            hvac.exceptions.InvalidPath -- the secret does not exist
+        '''
+        if not SECRET_CACHE_ENABLED:
+            return self._copy(self._flight.do(name, load, name))
+
+        with self._lock:
+            entry = self._entries.get(name)
+
+            if entry is not None:
+                expires_at, buffer = entry
+
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(name)
+
+                    if buffer is None:
+                        self._negative_hits += 1
+                        raise exceptions.InvalidPath()
+
+                    self._hits += 1
+                    return {'data': json.loads(buffer.decode('utf-8'))}
+
+                self._drop(name)
+                self._expirations += 1
+
+            self._misses += 1
+            generation = self._generation
+
+        return self._copy(self._flight.do(name, self._load, name, load, generation))
+
+    def _load(self, name, load, generation):
+        try:
+            secret = load(name)
+        except exceptions.InvalidPath:
+            self._put(name, None, SECRET_CACHE_NEGATIVE_TTL, generation)
+            raise
+
+        self._put(name, bytearray(json.dumps(secret['data']).encode('utf-8')), SECRET_CACHE_TTL, generation)
+
+        return secret
+
+    @staticmethod
+    def _copy(secret):
+        # a coalesced load is shared by all its waiters
+        return {'data': dict(secret['data'])}
+
+    def invalidate(self, name):
+        with self._lock:
+            # reads in flight must not cache what they loaded before the change
+            self._generation += 1
+            self._drop(name)
+
+        # nor hand it to reads starting after the change
+        self._flight.forget(name)
+
+    def _put(self, name, buffer, ttl, generation):
+        with self._lock:
+            if generation != self._generation:
+                _zeroize(buffer)
+                return
+
+            self._drop(name)
+            self._entries[name] = (time.monotonic() + ttl, buffer)
+
+            while len(self._entries) > SECRET_CACHE_SIZE:
+                self._drop(next(iter(self._entries)))
+                self._evictions += 1
+
+    def _drop(self, name):
+        entry = self._entries.pop(name, None)
+
+        if entry is not None:
+            _zeroize(entry[1])
+
+    def stats(self):
+        lookups = self._hits + self._negative_hits + self._misses
+
+        return {
+            'enabled': SECRET_CACHE_ENABLED,
+            'size': len(self._entries),
+            'max_size': SECRET_CACHE_SIZE,
+            'hits': self._hits,
+            'negative_hits': self._negative_hits,
+            'misses': self._misses,
+            'hit_rate': (self._hits + self._negative_hits) / lookups if lookups else 0.0,
+            'evictions': self._evictions,
+            'expirations': self._expirations
+        }
@@ -0,0 +1,127 @@
+'''[summary]
+Request coalescing
+[description]
+Collapses concurrent identical reads of a backend into one call: the first caller of a
+key calls the backend, callers of the same key arriving while it is in flight wait for
+it and get its result, or its exception. During a node-join burst hundreds of requests
+for the CRL, the CA certificate or the app secret object then cost one backend call.
+'''
+import os
+import threading
+
+
+# Coalesce concurrent identical backend reads
+SINGLE_FLIGHT_ENABLED = True
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''[summary]
+    Concurrent calls of one backend read, by key
+    [description]
+    Results are shared between the waiters and must not be modified. A write must call
+    forget() with the key it changed once it is done, so later reads do not join a call
+    that started before the write and return what it read.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._pid = os.getpid()
+        self._backend_calls = 0
+        self._shared = 0
+        self._forgotten = 0
+
+    def do(self, key, func, *args, **kwargs):
+        '''[summary]
+        Call func, or wait for the call of the same key in flight
+        '''
+        if not SINGLE_FLIGHT_ENABLED:
+            return func(*args, **kwargs)
+
+        with self._lock:
+            # calls in flight in the parent do not complete in a forked child
+            if self._pid != os.getpid():
+                self._calls = {}
+                self._pid = os.getpid()
+
+            call = self._calls.get(key)
+
+            if call is not None:
+                self._shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._backend_calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+            call.done.set()
+
+        return call.result
+
+    def forget(self, key=None):
+        '''[summary]
+        Let the next read of key, of every key if None, call the backend again
+        '''
+        with self._lock:
+            if key is None:
+                self._forgotten += len(self._calls)
+                self._calls = {}
+            elif self._calls.pop(key, None) is not None:
+                self._forgotten += 1
+
+    def stats(self):
+        calls = self._backend_calls + self._shared
+
+        return {
+            'in_flight': len(self._calls),
+            'backend_calls': self._backend_calls,
+            'saved_calls': self._shared,
+            'saved_rate': self._shared / calls if calls else 0.0,
+            'forgotten': self._forgotten
+        }
+
+
+_flights = {}
+
+_registry_lock = threading.Lock()
+
+
+def get_single_flight(name):
+    flight = _flights.get(name)
+
+    if flight is None:
+        with _registry_lock:
+            flight = _flights.setdefault(name, SingleFlight(name))
+
+    return flight
+
+
+def single_flight_stats():
+    return {name: flight.stats() for name, flight in list(_flights.items())}
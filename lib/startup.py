@@ -0,0 +1,194 @@
+'''[summary]
+Startup module
+[description]
+Initializes the backends once, before the first request: in the gunicorn master before
+the workers are forked (see gunicorn.conf.py), or in a background thread of the worker.
+Tracks the state of every backend for the readiness endpoint.
+'''
+import logging
+import threading
+import time
+
+
+# Seconds between attempts to initialize backends that failed
+WARMUP_RETRY_INTERVAL = 5
+
+
+def _init_vault():
+    from lib.vault_backend import VaultBackend
+    VaultBackend()
+
+
+def _init_vault_pki():
+    from lib.pki_cache import PkiCache
+    PkiCache().get('ca')
+
+
+def _init_cert_pool():
+    from lib import cert_pool
+
+    # registers the pool, so the workers start filling it before the first request
+    if cert_pool.CERT_POOL_ENABLED:
+        cert_pool.CertificatePool()
+
+
+def _init_kubernetes():
+    from lib.kubernetes_backend import KubernetesBackend
+    KubernetesBackend()
+
+
+def _init_join_tokens():
+    from lib.join_token_backend import JoinTokenBackend
+    JoinTokenBackend()
+
+
+def _reset_vault():
+    from lib.vault_backend import VaultBackend
+    VaultBackend().after_fork()
+
+
+def _reset_kubernetes():
+    from lib.kubernetes_backend import KubernetesBackend
+    KubernetesBackend().after_fork()
+
+
+class _Backend:
+    def __init__(self, name, init, reset=None, required=True):
+        self.name = name
+        self.init = init
+        self.reset = reset
+        self.required = required
+        self.state = 'pending'
+        self.error = None
+        self.duration = None
+
+
+# in order of initialization
+_backends = [
+    _Backend('vault', _init_vault, _reset_vault),
+    _Backend('vault_pki', _init_vault_pki),
+    _Backend('cert_pool', _init_cert_pool, required=False),
+    _Backend('kubernetes', _init_kubernetes, _reset_kubernetes, required=False),
+    _Backend('join_tokens', _init_join_tokens, required=False)
+]
+
+_lock = threading.Lock()
+
+
+def warm_up(prefork=False):
+    '''[summary]
+    Initialize every backend that is not ready yet
+    [description]
+    Idempotent, backends that are ready are skipped. A failing backend is recorded and
+    does not stop the others.
+
+    Arguments:
+        prefork -- called in the gunicorn master, which must not log in to Vault or start
+                   threads holding locks the forked workers would inherit
+
+    Returns:
+        [type] bool -- [description] True if every required backend is ready
+    '''
+    from lib.vault_token import VaultTokenManager
+
+    logger = logging.getLogger('flask.app')
+
+    VaultTokenManager().prefork = prefork
+
+    with _lock:
+        for backend in _backends:
+            if backend.state == 'ready':
+                continue
+
+            backend.state = 'initializing'
+            started = time.monotonic()
+
+            try:
+                backend.init()
+            except Exception as error:
+                backend.state = 'failed'
+                backend.error = str(error) or error.__class__.__name__
+
+                logger.error('Failed to initialize backend %s.', backend.name)
+                logger.info(error)
+            else:
+                backend.state = 'ready'
+                backend.error = None
+            finally:
+                backend.duration = time.monotonic() - started
+
+    return is_ready()
+
+
+def warm_up_in_background():
+    '''[summary]
+    Initialize the backends in a background thread
+    [description]
+    Retried every WARMUP_RETRY_INTERVAL seconds until every required backend is ready,
+    then the pools registered meanwhile start filling.
+    '''
+    from lib.warm_pool import start_warm_pools
+
+    def run():
+        while not warm_up():
+            time.sleep(WARMUP_RETRY_INTERVAL)
+
+        start_warm_pools()
+
+    thread = threading.Thread(target=run, name='warmup', daemon=True)
+    thread.start()
+
+    return thread
+
+
+def after_fork(workers=1):
+    '''[summary]
+    Drop connections inherited from the parent process
+    [description]
+    The backends stay initialized, only their sockets are closed in the child, so the
+    workers do not share connections with the master or with each other. Every worker
+    logs in to Vault on its own. Pools of pre-created items registered by the backends
+    start filling in the child, and so do the certificate index and the certificate
+    renewal scheduler.
+
+    Arguments:
+        workers -- number of worker processes, pools sized per deployment share their
+                   watermarks between them
+    '''
+    from lib import cert_renewal
+    from lib.cert_index import CertificateIndex
+    from lib.vault_token import VaultTokenManager
+    from lib.warm_pool import start_warm_pools
+
+    VaultTokenManager().after_fork()
+
+    for backend in _backends:
+        if backend.state == 'ready' and backend.reset is not None:
+            try:
+                backend.reset()
+            except Exception as error:
+                logging.getLogger('flask.app').info(error)
+
+    start_warm_pools(workers)
+
+    # builds the certificate index before the first listing asks for it
+    if is_ready():
+        CertificateIndex().start()
+
+    if cert_renewal.CERT_RENEWAL_ENABLED:
+        cert_renewal.CertificateRenewal().start()
+
+
+def is_ready():
+    return all(backend.state == 'ready' for backend in _backends if backend.required)
+
+
+def readiness():
+    return {
+        backend.name: {
+            'state': backend.state,
+            'required': backend.required,
+            'error': backend.error,
+            'duration': backend.duration
+        } for backend in _backends
+    }
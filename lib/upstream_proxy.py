@@ -0,0 +1,138 @@
+import threading
+from flask import Response
+from lib.http_pool import get_session_pool
+from lib.metrics import timed
+from lib.resilience import get_breaker
+
+
+# Seconds to wait for a connection to an upstream and for each read of its response
+UPSTREAM_CONNECT_TIMEOUT = 3.05
+UPSTREAM_READ_TIMEOUT = 60
+
+# Maximum number of requests in flight to one upstream per worker
+UPSTREAM_CONCURRENCY = 16
+
+# Seconds a request waits for a free slot before it is rejected
+UPSTREAM_QUEUE_TIMEOUT = 5
+
+# Bytes buffered at a time while streaming bodies in either direction
+UPSTREAM_CHUNK_SIZE = 64 * 1024
+
+# Headers that describe a single connection and are not forwarded
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+    'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length'
+])
+
+# Response headers set by our own server
+SERVER_HEADERS = frozenset(['server', 'date'])
+
+
+class UpstreamBusyError(Exception):
+    pass
+
+
+class _RequestBody:
+    '''[summary]
+    Request body of known length, read in bounded chunks
+    '''
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > UPSTREAM_CHUNK_SIZE:
+            size = UPSTREAM_CHUNK_SIZE
+
+        return self._stream.read(size)
+
+
+def _chunks(stream):
+    while True:
+        chunk = stream.read(UPSTREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+class UpstreamProxy:
+    '''[summary]
+    Streaming reverse proxy to an upstream service
+    [description]
+    Bodies are piped through in chunks in both directions instead of being buffered,
+    over keep-alive connections shared by the worker. The number of requests in flight
+    is limited per upstream, and a circuit breaker fails requests at once while the
+    upstream keeps answering with 5xx or is unreachable.
+    '''
+
+    def __init__(self, name, base_url, concurrency=UPSTREAM_CONCURRENCY,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT, read_timeout=UPSTREAM_READ_TIMEOUT):
+        self.name = name
+        self._base_url = base_url
+        self._http = get_session_pool(name, pool_size=concurrency, timeout=(connect_timeout, read_timeout))
+        self._slots = threading.BoundedSemaphore(concurrency)
+        # slow answers are expected, only timeouts count
+        self._breaker = get_breaker(name, failed_result=lambda resp: resp.status_code >= 500, slow_call=read_timeout)
+
+    def forward(self, method, path, incoming=None):
+        '''[summary]
+        Forward a request to the upstream
+        [description]
+        Arguments:
+            method -- HTTP method used towards the upstream
+            path -- path appended to the base url
+            incoming -- the flask request whose headers and body are forwarded, if any
+
+        Returns:
+            [type] Response -- [description] streaming response relaying the upstream's reply
+
+        Raises:
+            UpstreamBusyError -- no free slot within UPSTREAM_QUEUE_TIMEOUT seconds
+            CircuitBreakerOpenError -- the upstream is failing
+            requests.exceptions.RequestException -- the upstream is unreachable
+        '''
+        headers = {}
+        body = None
+
+        if incoming is not None:
+            headers = {name: value for name, value in incoming.headers.items()
+                       if name.lower() not in HOP_BY_HOP_HEADERS}
+
+            if incoming.content_length is not None:
+                body = _RequestBody(incoming.stream, incoming.content_length)
+            elif incoming.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = _chunks(incoming.stream)
+
+        if not self._slots.acquire(timeout=UPSTREAM_QUEUE_TIMEOUT):
+            raise UpstreamBusyError()
+
+        try:
+            with timed(self.name, method):
+                upstream = self._breaker.call(self._http.request, method, self._base_url + path, data=body,
+                                              headers=headers, stream=True)
+        except Exception:
+            self._slots.release()
+            raise
+
+        released = []
+
+        def close():
+            if not released:
+                released.append(True)
+                upstream.close()
+                self._slots.release()
+
+        # relay the body as received, so Content-Encoding and Content-Length stay valid
+        response_headers = [(name, value) for name, value in upstream.headers.items()
+                            if name.lower() == 'content-length'
+                            or name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in SERVER_HEADERS]
+
+        response = Response(upstream.raw.stream(UPSTREAM_CHUNK_SIZE, decode_content=False),
+                            status=upstream.status_code, headers=response_headers)
+        response.call_on_close(close)
+
+        return response
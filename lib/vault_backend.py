@@ -1,6 +1,11 @@
 import logging
-import requests
-from hvac import Client
+import threading
+from hvac import Client, exceptions
+from lib.http_pool import get_session_pool
+from lib.metrics import timed
+from lib.resilience import get_breaker, get_hedge
+from lib.single_flight import get_single_flight
+from lib.vault_token import VAULT_APPROLE_KV_V2_POLICY, VAULT_APPROLE_POLICY, VaultTokenManager
 
 
 # "http://127.0.0.1:5003" for localhost test,
@@ -25,11 +30,54 @@ VAULT_TOKEN_FILE = 'vaulttoken'
 # File to store keys to unseal the vault
 UNSEAL_KEYS_FILE = 'unsealkeys'
 
+# Version of the KV secrets engine mounted at secret/: 1, or 2 for versioned secrets with
+# check-and-set writes and soft deletes (updates in one request need Vault 1.9 or later)
+VAULT_KV_VERSION = 1
+
+# Domains of the PKI role micado, certificates are issued for their subdomains
+VAULT_PKI_DOMAINS = ['micado']
+
+# Keep-alive connections kept open to Vault for PKI traffic
+VAULT_POOL_SIZE = 32
+
+# Seconds to wait for a connection to Vault and for its response
+VAULT_CONNECT_TIMEOUT = 3.05
+VAULT_READ_TIMEOUT = 30
+
+
+def _vault_failure(error):
+    # answers to invalid requests do not mean Vault is in trouble
+    return not isinstance(error, (exceptions.InvalidPath, exceptions.InvalidRequest, exceptions.Forbidden,
+                                  exceptions.Unauthorized))
+
+
+def _vault_breaker():
+    '''[summary]
+    Circuit breaker of Vault, shared by the KV and PKI backends
+    '''
+    # hvac raises on error statuses and returns dicts, the PKI backend returns the responses
+    return get_breaker('vault', failure=_vault_failure,
+                       failed_result=lambda resp: getattr(resp, 'status_code', 200) >= 500)
+
 
 class VaultBackendError(Exception):
     pass
 
 
+class VaultBackendUnsupportedError(VaultBackendError):
+    '''[summary]
+    The operation needs the KV version 2 secrets engine
+    '''
+    pass
+
+
+class VaultBackendConflictError(VaultBackendError):
+    '''[summary]
+    A check-and-set write found another version of the secret
+    '''
+    pass
+
+
 class VaultBackend:
     # The Borg Singleton
     __shared_state = {}
@@ -39,6 +87,10 @@ class VaultBackend:
     _token = ""
     
     _unseal_keys = ""
+
+    _initialized = False
+
+    _init_lock = threading.Lock()
     
     def __init__(self):
         '''[summary]
@@ -49,33 +101,52 @@ class VaultBackend:
         # The Borg Singleton
         self.__dict__ = self.__shared_state
 
-        if not self.client:
-            self._logger = logging.getLogger('flask.app')
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    self._init()
 
-            self._logger.info('Initializing Vault @ %s .', VAULT_URL)
+    def _init(self):
+        self._logger = logging.getLogger('flask.app')
 
-            self.client = Client(url=VAULT_URL)
+        self._logger.info('Initializing Vault @ %s .', VAULT_URL)
 
-            if self._is_vault_initialized():
-                self._logger.info('Vault already initalized.')
+        self.client = Client(url=VAULT_URL, timeout=(VAULT_CONNECT_TIMEOUT, VAULT_READ_TIMEOUT))
 
-                self._load_keys()
-            else:
-                vault = self._init_vault()
-                self._token = vault['root_token']
-                self._unseal_keys = vault['keys']
+        if self._is_vault_initialized():
+            self._logger.info('Vault already initalized.')
+
+            self._load_keys()
+        else:
+            vault = self._init_vault()
+            self._token = vault['root_token']
+            self._unseal_keys = vault['keys']
+
+            self._logger.info('Vault initalized.')
+
+            self._save_keys()
+
+        self.client.token = self._token
+
+        self._logger.info('Unsealing Vault.')
 
-                self._logger.info('Vault initalized.')
+        self._unseal_vault()
 
-                self._save_keys()
+        self._logger.info('Vault unsealed.')
 
-            self.client.token = self._token
+        if VAULT_KV_VERSION == 2:
+            self._mount_kv_v2()
 
-            self._logger.info('Unsealing Vault.')
+        # updates are sent as PATCH until Vault turns out not to support it
+        self._patch_supported = True
 
-            self._unseal_vault()
+        self._breaker = _vault_breaker()
 
-            self._logger.info('Vault unsealed.')
+        self._tokens = VaultTokenManager()
+        self._tokens.configure(VAULT_URL, self._token,
+                               VAULT_APPROLE_POLICY + (VAULT_APPROLE_KV_V2_POLICY if VAULT_KV_VERSION == 2 else ''))
+
+        self._initialized = True
 
     def _load_keys(self):
         try:
@@ -136,6 +207,232 @@ class VaultBackend:
             self._logger.info(error)
             raise VaultBackendError()
 
+    def _mount_kv_v2(self):
+        try:
+            mounts = self.client.sys.list_mounted_secrets_engines()
+            mount = mounts.get('data', mounts).get('secret/')
+
+            if mount is None:
+                self._logger.info('Mounting KV version 2 secrets engine at secret/.')
+                self.client.sys.enable_secrets_engine('kv', path='secret', options={'version': '2'})
+            elif (mount.get('options') or {}).get('version') != '2':
+                # Vault upgrades the stored secrets in the background; sent as is since
+                # tune_mount_configuration of hvac drops the options
+                self._logger.info('Upgrading secrets engine at secret/ to KV version 2.')
+                self.client.adapter.post('/v1/sys/mounts/secret/tune', json={'options': {'version': '2'}})
+        except Exception as error:
+            self._logger.error('Failed to mount KV version 2 secrets engine.')
+            self._logger.info(error)
+            raise VaultBackendError()
+
+    def after_fork(self):
+        '''[summary]
+        Drop the connections inherited from the parent process
+        '''
+        self.client.adapter.close()
+
+    def _call(self, name, operation, **kwargs):
+        token = self._tokens.token()
+        self.client.token = token
+
+        with timed('vault_kv', name):
+            try:
+                return self._breaker.call(operation, **kwargs)
+            except exceptions.Forbidden:
+                if not self._tokens.refresh(token):
+                    raise
+
+            self.client.token = self._tokens.token()
+
+            return self._breaker.call(operation, **kwargs)
+
+    def read_secret(self, name, version=None):
+        '''[summary]
+        Read a secret
+        [description]
+        Arguments:
+            version -- version to read instead of the latest one (KV version 2)
+
+        Returns:
+            [type] dict -- [description] data with secret_value, and its version with KV version 2
+
+        Raises:
+            hvac.exceptions.InvalidPath -- the secret, or the version, does not exist or is deleted
+        '''
+        if VAULT_KV_VERSION != 2:
+            if version is not None:
+                raise VaultBackendUnsupportedError()
+
+            return self._call('read', self.client.secrets.kv.v1.read_secret, path=name)
+
+        secret = self._call('read', self.client.secrets.kv.v2.read_secret_version, path=name,
+                            version=version)['data']
+
+        return {'data': dict(secret['data'], version=secret['metadata']['version'])}
+
+    def write_secret(self, name, value, cas=None):
+        '''[summary]
+        Create or update a secret
+        [description]
+        Arguments:
+            cas -- with KV version 2, only write if the current version is cas, 0 if the secret must not exist;
+                   a secret whose latest version is deleted or destroyed does not exist
+
+        Returns:
+            [type] int -- [description] the version written with KV version 2, else None
+
+        Raises:
+            VaultBackendConflictError -- the current version is not cas
+        '''
+        if VAULT_KV_VERSION != 2:
+            if cas is not None:
+                raise VaultBackendUnsupportedError()
+
+            # POST creates or updates; without a method hvac reads the secret first to choose one
+            self._call('write', self.client.secrets.kv.v1.create_or_update_secret, path=name,
+                       secret={'secret_value': value}, method='POST')
+            return None
+
+        try:
+            return self._write_v2(name, value, cas)
+        except VaultBackendConflictError:
+            if cas != 0:
+                raise
+
+        # the metadata of a deleted secret is kept, Vault only accepts its current version as cas
+        metadata = self._call('metadata', self.client.secrets.kv.v2.read_secret_metadata, path=name)['data']
+
+        version = metadata['current_version']
+        current = metadata['versions'].get(str(version), {})
+
+        if not current.get('deletion_time') and not current.get('destroyed'):
+            raise VaultBackendConflictError()
+
+        return self._write_v2(name, value, version)
+
+    def _write_v2(self, name, value, cas):
+        try:
+            return self._call('write', self.client.secrets.kv.v2.create_or_update_secret, path=name,
+                              secret={'secret_value': value}, cas=cas)['data']['version']
+        except exceptions.InvalidRequest as error:
+            if cas is not None and 'check-and-set' in str(error):
+                raise VaultBackendConflictError()
+            raise
+
+    def update_secret(self, name, value):
+        '''[summary]
+        Update a secret that exists
+        [description]
+        With KV version 2 a single PATCH request, which Vault rejects if the secret does
+        not exist. If Vault does not support PATCH, the current version is read from the
+        metadata and written with check-and-set.
+
+        Returns:
+            [type] int -- [description] the version written with KV version 2, else None
+
+        Raises:
+            hvac.exceptions.InvalidPath -- the secret does not exist
+            VaultBackendConflictError -- the secret changed between the two requests of the fallback
+        '''
+        if VAULT_KV_VERSION != 2:
+            self.read_secret(name)
+            return self.write_secret(name, value)
+
+        if self._patch_supported:
+            try:
+                return self._call('update', self._patch, path=name, secret={'secret_value': value})['data']['version']
+            except exceptions.UnexpectedError as error:
+                # 405 from Vault before 1.9
+                if '405' not in str(error) and 'unsupported operation' not in str(error):
+                    raise
+
+                self._logger.info('Vault does not support PATCH, updating secrets with check-and-set.')
+                self._patch_supported = False
+
+        version = self.secret_version(name)
+
+        if version is None:
+            raise exceptions.InvalidPath()
+
+        return self.write_secret(name, value, cas=version)
+
+    def _patch(self, path, secret):
+        return self.client.adapter.request('PATCH', '/v1/secret/data/' + path, json={'data': secret},
+                                           headers={'Content-Type': 'application/merge-patch+json'})
+
+    def secret_version(self, name):
+        '''[summary]
+        Get the current version of a secret from its metadata, without reading it
+        [description]
+        Returns:
+            [type] int -- [description] the current version, None if the secret does not exist or is deleted
+        '''
+        if VAULT_KV_VERSION != 2:
+            raise VaultBackendUnsupportedError()
+
+        try:
+            metadata = self._call('metadata', self.client.secrets.kv.v2.read_secret_metadata, path=name)['data']
+        except exceptions.InvalidPath:
+            return None
+
+        version = metadata['current_version']
+        current = metadata['versions'].get(str(version), {})
+
+        if not version or current.get('deletion_time') or current.get('destroyed'):
+            return None
+
+        return version
+
+    def delete_secret(self, name):
+        '''[summary]
+        Delete a secret
+        [description]
+        With KV version 2 the latest version is deleted softly and can be undeleted.
+        '''
+        if VAULT_KV_VERSION != 2:
+            return self._call('delete', self.client.secrets.kv.v1.delete_secret, path=name)
+
+        return self._call('delete', self.client.secrets.kv.v2.delete_latest_version_of_secret, path=name)
+
+    def undelete_secret(self, name):
+        '''[summary]
+        Restore the latest version of a secret deleted softly (KV version 2)
+        [description]
+        Returns:
+            [type] int -- [description] the restored version
+
+        Raises:
+            hvac.exceptions.InvalidPath -- the secret does not exist or its latest version is not deleted
+        '''
+        if VAULT_KV_VERSION != 2:
+            raise VaultBackendUnsupportedError()
+
+        metadata = self._call('metadata', self.client.secrets.kv.v2.read_secret_metadata, path=name)['data']
+
+        version = metadata['current_version']
+        current = metadata['versions'].get(str(version), {})
+
+        if not current.get('deletion_time') or current.get('destroyed'):
+            raise exceptions.InvalidPath()
+
+        self._call('undelete', self.client.secrets.kv.v2.undelete_secret_versions, path=name, versions=[version])
+
+        return version
+
+    def purge_secret(self, name):
+        '''[summary]
+        Delete a secret with all its versions, for secrets SPM keeps for itself
+        '''
+        if VAULT_KV_VERSION != 2:
+            return self.delete_secret(name)
+
+        return self._call('delete', self.client.secrets.kv.v2.delete_metadata_and_all_versions, path=name)
+
+    def list_secrets(self, path):
+        kv = self.client.secrets.kv.v2 if VAULT_KV_VERSION == 2 else self.client.secrets.kv.v1
+
+        return self._call('list', kv.list_secrets, path=path)['data']['keys']
+
 
 class VaultPkiBackend:
     # The Borg Singleton
@@ -143,29 +440,77 @@ class VaultPkiBackend:
 
     _vault_backend = None
 
+    _initialized = False
+
+    _init_lock = threading.Lock()
+
     def __init__(self, ):
         # The Borg Singleton
         self.__dict__ = self.__shared_state
 
-        if not self._vault_backend:
-            # this takes care of initialization, getting and the token unsealing
-            self._vault_backend = VaultBackend()
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    self._init()
+
+    def _init(self):
+        # this takes care of initialization, getting and the token unsealing
+        self._vault_backend = VaultBackend()
 
-            self._logger = logging.getLogger('flask.app')
+        self._logger = logging.getLogger('flask.app')
 
-            self._init_pki()
+        # shared by all threads of the worker, keeps connections to Vault alive
+        self._http = get_session_pool('vault', pool_size=VAULT_POOL_SIZE,
+                                      timeout=(VAULT_CONNECT_TIMEOUT, VAULT_READ_TIMEOUT))
+
+        self._breaker = _vault_breaker()
+        self._hedge = get_hedge('vault_pki')
+        self._reads = get_single_flight('vault_pki')
+
+        self._init_pki()
+
+        self._initialized = True
+
+    def _request(self, method, path, payload=None):
+        tokens = VaultTokenManager()
+        token = tokens.token()
+
+        with timed('vault_pki', method):
+            resp = self._breaker.call(self._http.request, method, VAULT_URL + path, headers={'X-Vault-Token': token},
+                                      json=payload)
+
+            if resp.status_code == 403 and tokens.refresh(token):
+                resp = self._breaker.call(self._http.request, method, VAULT_URL + path,
+                                          headers={'X-Vault-Token': tokens.token()}, json=payload)
+
+        return resp
 
     def get(self, path):
-        return requests.get(VAULT_URL + path, headers={'X-Vault-Token': self._vault_backend._token})
+        return self._request('GET', path)
 
     def getAnonymous(self, path):
-        return requests.get(VAULT_URL + path)
+        '''[summary]
+        Read a public PKI path, the CA certificate, the CRL or a certificate
+        [description]
+        These reads are idempotent and hedged, concurrent reads of a path share one call
+        and its response.
+        '''
+        with timed('vault_pki', 'GET'):
+            return self._reads.do(path, self._hedge.call, self._breaker.call, self._http.get, VAULT_URL + path)
+
+    def forget(self, path=None):
+        '''[summary]
+        Let the next anonymous read of path, of every path if None, go to Vault again
+        [description]
+        For changes of a public PKI path, e.g. the CRL after a revocation.
+        '''
+        self._reads.forget(path)
 
     def post(self, path, payload=None):
-        return requests.post(VAULT_URL + path, headers={'X-Vault-Token': self._vault_backend._token}, json=payload)
+        return self._request('POST', path, payload)
 
     def list(self, path):
-        return requests.request('LIST', VAULT_URL + path, headers={'X-Vault-Token': self._vault_backend._token})
+        return self._request('LIST', path)
 
     def _init_pki(self):
         self._logger.info('Initializing Vault PKI backend.')
@@ -239,7 +584,7 @@ class VaultPkiBackend:
         self._logger.info('Creating role for signing.')
 
         params = {
-            'allowed_domains': ['micado'],
+            'allowed_domains': VAULT_PKI_DOMAINS,
             'allow_subdomains': 'true',
             'max_ttl': '8760h'
         }
@@ -0,0 +1,288 @@
+import logging
+import os
+import threading
+import time
+from lib.http_pool import get_session_pool
+
+
+# How SPM authenticates to Vault: 'root' uses the root token from VAULT_TOKEN_FILE
+# for every request, 'approle' sets up an AppRole with a scoped policy once (with
+# the root token) and every worker logs in with it
+VAULT_AUTH_METHOD = 'root'
+
+# Name of the AppRole and of its policy
+VAULT_APPROLE_NAME = 'spm'
+
+# Seconds the tokens of the AppRole are valid, and at most with renewals
+VAULT_APPROLE_TOKEN_TTL = 3600
+VAULT_APPROLE_TOKEN_MAX_TTL = 24 * 3600
+
+# Paths SPM uses, granted to the AppRole
+VAULT_APPROLE_POLICY = '''
+path "secret/*" {
+  capabilities = ["create", "read", "update", "delete", "list"]
+}
+path "pki/*" {
+  capabilities = ["create", "read", "update", "delete", "list", "sudo"]
+}
+path "sys/mounts/pki" {
+  capabilities = ["create", "update"]
+}
+'''
+
+# Added to the policy with the KV version 2 engine, whose updates need the patch capability
+VAULT_APPROLE_KV_V2_POLICY = '''
+path "secret/data/*" {
+  capabilities = ["create", "read", "update", "delete", "list", "patch"]
+}
+'''
+
+# Fraction of the token's TTL after which it is renewed
+VAULT_TOKEN_RENEW_FRACTION = 2 / 3
+
+# Seconds between attempts to renew a token or log in again after a failure
+VAULT_TOKEN_RETRY_INTERVAL = 5
+
+
+class VaultTokenError(Exception):
+    pass
+
+
+class VaultTokenManager:
+    '''[summary]
+    Vault token of SPM
+    [description]
+    Holds the token in memory for the hvac client and for the PKI requests. With
+    AppRole authentication every worker logs in on first use and renews its token in
+    the background before VAULT_TOKEN_RENEW_FRACTION of its TTL has passed, logging in
+    again once it reaches its max TTL, so requests never wait for authentication.
+    A request rejected with 403 is retried once with a fresh token. The gunicorn master
+    initializes the backends with the root token (prefork), only the workers log in.
+    '''
+    # The Borg Singleton
+    __shared_state = {}
+
+    _configured = False
+
+    prefork = False
+
+    def __init__(self):
+        # The Borg Singleton
+        self.__dict__ = self.__shared_state
+
+    def configure(self, vault_url, root_token, policy=VAULT_APPROLE_POLICY):
+        '''[summary]
+        Set up authentication, called once Vault is unsealed
+        [description]
+        Arguments:
+            root_token -- used as is in 'root' mode, or to set up the AppRole
+            policy -- policy of the AppRole
+        '''
+        self._logger = logging.getLogger('flask.app')
+        self._vault_url = vault_url
+        self._http = get_session_pool('vault-auth', pool_size=2)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._token = root_token
+        self._renew_at = None
+        self._expires_at = None
+        self._logins = 0
+        self._renewals = 0
+        self._failures = 0
+
+        if VAULT_AUTH_METHOD == 'approle':
+            self._role_id, self._secret_id = self._provision(root_token, policy)
+
+        self._configured = True
+
+    def token(self):
+        '''[summary]
+        Get the current token
+        [description]
+        Logs in first if this process has no token of its own yet, except before the
+        workers are forked.
+        '''
+        if VAULT_AUTH_METHOD == 'approle' and self._pid != os.getpid() and not self.prefork:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._login()
+                    self._pid = os.getpid()
+
+                    threading.Thread(target=self._run, name='vault-token', daemon=True).start()
+
+        return self._token
+
+    def refresh(self, rejected_token):
+        '''[summary]
+        Replace a token Vault rejected
+        [description]
+        Concurrent callers with the same rejected token cause a single login.
+
+        Returns:
+            [type] bool -- [description] True if there is a new token worth retrying with
+        '''
+        if VAULT_AUTH_METHOD != 'approle' or self.prefork:
+            return False
+
+        with self._lock:
+            if self._token != rejected_token:
+                return True
+
+            self._logger.info('Vault rejected the token, logging in again.')
+
+            try:
+                self._login()
+            except Exception as error:
+                self._logger.error('Unable to log in to Vault.')
+                self._logger.info(error)
+                return False
+
+        return True
+
+    def after_fork(self):
+        '''[summary]
+        Prepare the token manager of the parent process for use in a forked child
+        [description]
+        The child logs in on first use. Its lock is new, the one of the parent may have
+        been held by a thread that does not exist in the child.
+        '''
+        self.prefork = False
+
+        if self._configured:
+            self._lock = threading.Lock()
+            self._pid = None
+
+    def _request(self, method, path, token, payload=None):
+        resp = self._http.request(method, self._vault_url + path, headers={'X-Vault-Token': token}, json=payload)
+
+        if resp.status_code not in (200, 204):
+            raise VaultTokenError('%s %s: %s %s' % (method, path, resp.status_code, resp.text))
+
+        return resp.json() if resp.status_code == 200 else None
+
+    def _provision(self, root_token, policy):
+        self._logger.info('Setting up AppRole %s in Vault.', VAULT_APPROLE_NAME)
+
+        resp = self._http.post(self._vault_url + '/v1/sys/auth/approle', headers={'X-Vault-Token': root_token},
+                               json={'type': 'approle'})
+
+        # 400 if already enabled
+        if resp.status_code not in (204, 400):
+            raise VaultTokenError(resp.text)
+
+        self._request('PUT', '/v1/sys/policy/' + VAULT_APPROLE_NAME, root_token, {'policy': policy})
+
+        self._request('POST', '/v1/auth/approle/role/' + VAULT_APPROLE_NAME, root_token, {
+            'token_policies': [VAULT_APPROLE_NAME],
+            'token_ttl': VAULT_APPROLE_TOKEN_TTL,
+            'token_max_ttl': VAULT_APPROLE_TOKEN_MAX_TTL
+        })
+
+        role_id = self._request('GET', '/v1/auth/approle/role/%s/role-id' % VAULT_APPROLE_NAME,
+                                root_token)['data']['role_id']
+        secret = self._request('POST', '/v1/auth/approle/role/%s/secret-id' % VAULT_APPROLE_NAME,
+                               root_token)['data']
+
+        self._destroy_secret_ids(root_token, secret['secret_id_accessor'])
+
+        return role_id, secret['secret_id']
+
+    def _destroy_secret_ids(self, root_token, keep):
+        '''[summary]
+        Destroy the secret IDs of the AppRole created by earlier starts
+        [description]
+        Every start creates a secret ID, the workers log in with it for as long as they
+        run, so it has no TTL. The ones of earlier starts are not needed anymore, this
+        keeps a single valid credential. Failures are logged, the new secret ID works.
+        '''
+        path = '/v1/auth/approle/role/%s/secret-id' % VAULT_APPROLE_NAME
+
+        try:
+            resp = self._http.request('LIST', self._vault_url + path, headers={'X-Vault-Token': root_token})
+
+            # 404 if there are none
+            if resp.status_code == 404:
+                return
+
+            if resp.status_code != 200:
+                raise VaultTokenError('LIST %s: %s %s' % (path, resp.status_code, resp.text))
+
+            for accessor in resp.json()['data']['keys']:
+                if accessor != keep:
+                    self._request('POST', path + '-accessor/destroy', root_token, {'secret_id_accessor': accessor})
+        except Exception as error:
+            self._logger.error('Unable to destroy old secret IDs of AppRole %s.', VAULT_APPROLE_NAME)
+            self._logger.info(error)
+
+    def _login(self):
+        resp = self._http.post(self._vault_url + '/v1/auth/approle/login',
+                               json={'role_id': self._role_id, 'secret_id': self._secret_id})
+
+        if resp.status_code != 200:
+            self._failures += 1
+            raise VaultTokenError(resp.text)
+
+        self._set_token(resp.json()['auth'])
+        self._logins += 1
+
+        self._logger.info('Logged in to Vault with AppRole %s.', VAULT_APPROLE_NAME)
+
+    def _renew(self):
+        token = self._token
+
+        resp = self._http.post(self._vault_url + '/v1/auth/token/renew-self', headers={'X-Vault-Token': token},
+                               json={'increment': VAULT_APPROLE_TOKEN_TTL})
+
+        if resp.status_code != 200:
+            self._failures += 1
+            raise VaultTokenError(resp.text)
+
+        auth = resp.json()['auth']
+
+        with self._lock:
+            # not replaced by a login meanwhile
+            if self._token == token:
+                self._set_token(auth)
+                self._renewals += 1
+
+        # capped by the max TTL, a new token is needed before this one expires
+        return auth['lease_duration'] >= VAULT_APPROLE_TOKEN_TTL
+
+    def _set_token(self, auth):
+        now = time.monotonic()
+
+        self._token = auth['client_token']
+        self._expires_at = now + auth['lease_duration']
+        self._renew_at = now + auth['lease_duration'] * VAULT_TOKEN_RENEW_FRACTION
+
+    def _run(self):
+        while True:
+            time.sleep(max(self._renew_at - time.monotonic(), 0))
+
+            try:
+                if not self._renew():
+                    with self._lock:
+                        self._login()
+            except Exception as error:
+                self._logger.error('Unable to renew Vault token.')
+                self._logger.info(error)
+
+                try:
+                    with self._lock:
+                        self._login()
+                except Exception as error:
+                    self._logger.info(error)
+
+                    self._renew_at = time.monotonic() + VAULT_TOKEN_RETRY_INTERVAL
+
+    def stats(self):
+        if not self._configured:
+            return None
+
+        return {
+            'method': VAULT_AUTH_METHOD,
+            'ttl': max(int(self._expires_at - time.monotonic()), 0) if self._expires_at is not None else None,
+            'logins': self._logins,
+            'renewals': self._renewals,
+            'failures': self._failures
+        }
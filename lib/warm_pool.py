@@ -0,0 +1,245 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+
+class WarmPool:
+    '''[summary]
+    Pool of pre-created items refilled in the background
+    [description]
+    Items are handed out in O(1), oldest first. A background thread refills the pool
+    to the high watermark whenever it drops below the low watermark, and discards
+    items older than max_age. Items created in another process (before a fork) are
+    dropped from memory, so every item is handed out by one process only.
+
+    Arguments:
+        create -- callable returning a new item, may raise
+        discard -- callable releasing an item that expired or was dropped
+        sweep -- optional callable run every max_age seconds to clean up items
+                 orphaned by dead processes, receives the items held in memory
+        per_deployment -- the watermarks are for all the worker processes together,
+                          each process fills its share of them
+    '''
+
+    def __init__(self, name, create, discard, low, high, max_age, interval=1, sweep=None, per_deployment=False):
+        self.name = name
+        self._create = create
+        self._discard = discard
+        self._sweep = sweep
+        self._low = low
+        self._high = high
+        self._max_age = max_age
+        self._interval = interval
+        self._per_deployment = per_deployment
+
+        self._logger = logging.getLogger('flask.app')
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._items = collections.deque()
+        self._pid = None
+        self._last_sweep = 0
+        self._started_at = time.monotonic()
+
+        self._hits = 0
+        self._misses = 0
+        self._created = 0
+        self._expired = 0
+        self._failures = 0
+        self._refill_time = 0.0
+        self._last_refill_latency = 0.0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # items of the parent process are also held by its other children
+            self._items.clear()
+            self._pid = os.getpid()
+
+            threading.Thread(target=self._run, name='warmpool-' + self.name, daemon=True).start()
+
+    def _watermarks(self):
+        if not self._per_deployment:
+            return self._low, self._high
+
+        # rounded up, so every process keeps at least one item
+        return -(-self._low // _processes), -(-self._high // _processes)
+
+    def start(self):
+        '''[summary]
+        Start filling the pool in this process
+        [description]
+        Otherwise the pool is started by the first take().
+        '''
+        self._ensure_started()
+        self._wakeup.set()
+
+    def take(self):
+        '''[summary]
+        Take the oldest item from the pool
+        [description]
+        Returns:
+            [type] -- [description] an item, or None if the pool is empty
+        '''
+        self._ensure_started()
+
+        try:
+            created_at, item = self._items.popleft()
+        except IndexError:
+            item = None
+
+        with self._lock:
+            if item is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+        if len(self._items) < self._watermarks()[0]:
+            self._wakeup.set()
+
+        return item
+
+    def take_or_create(self):
+        '''[summary]
+        Take the oldest item, or create one if the pool is empty
+        [description]
+        The time callers wait for an item is recorded.
+        '''
+        started = time.monotonic()
+
+        item = self.take()
+
+        if item is None:
+            item = self._create()
+
+        waited = time.monotonic() - started
+
+        with self._lock:
+            self._waits += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        return item
+
+    def _run(self):
+        self._logger.info('Starting refiller of pool "%s".', self.name)
+
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+            try:
+                self._expire()
+
+                if len(self._items) < self._watermarks()[0]:
+                    self._refill()
+
+                if self._sweep is not None and time.monotonic() - self._last_sweep > self._max_age:
+                    self._last_sweep = time.monotonic()
+                    self._sweep([item for _, item in list(self._items)])
+            except Exception as error:
+                self._logger.error('Refiller of pool "%s" failed.', self.name)
+                self._logger.info(error)
+
+    def _expire(self):
+        now = time.monotonic()
+
+        while self._items and now - self._items[0][0] > self._max_age:
+            try:
+                created_at, item = self._items.popleft()
+            except IndexError:
+                break
+
+            with self._lock:
+                self._expired += 1
+
+            try:
+                self._discard(item)
+            except Exception as error:
+                self._logger.error('Unable to discard expired item of pool "%s".', self.name)
+                self._logger.info(error)
+
+    def _refill(self):
+        high = self._watermarks()[1]
+
+        while len(self._items) < high:
+            started = time.monotonic()
+
+            try:
+                item = self._create()
+            except Exception as error:
+                with self._lock:
+                    self._failures += 1
+
+                self._logger.error('Unable to refill pool "%s".', self.name)
+                self._logger.info(error)
+                return
+
+            latency = time.monotonic() - started
+
+            self._items.append((time.monotonic(), item))
+
+            with self._lock:
+                self._created += 1
+                self._refill_time += latency
+                self._last_refill_latency = latency
+
+    def stats(self):
+        low, high = self._watermarks()
+
+        return {
+            'size': len(self._items),
+            'low_watermark': low,
+            'high_watermark': high,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': self._hits / (self._hits + self._misses) if self._hits + self._misses else 0.0,
+            'created': self._created,
+            'expired': self._expired,
+            'refill_failures': self._failures,
+            'refill_latency_avg': self._refill_time / self._created if self._created else 0.0,
+            'refill_latency_last': self._last_refill_latency,
+            'refill_rate': self._created / (time.monotonic() - self._started_at),
+            'wait_time_avg': self._wait_time / self._waits if self._waits else 0.0,
+            'wait_time_max': self._max_wait_time
+        }
+
+
+_pools = {}
+
+# worker processes sharing the watermarks of per deployment pools
+_processes = 1
+
+
+def register_warm_pool(pool):
+    _pools[pool.name] = pool
+
+    return pool
+
+
+def warm_pool_stats():
+    return {name: pool.stats() for name, pool in list(_pools.items())}
+
+
+def start_warm_pools(processes=None):
+    '''[summary]
+    Start filling the pools in this process, one of processes worker processes
+    [description]
+    The number of processes given by an earlier call is kept if it is None.
+    '''
+    global _processes
+
+    if processes is not None:
+        _processes = max(processes, 1)
+
+    for pool in list(_pools.values()):
+        pool.start()
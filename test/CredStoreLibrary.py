@@ -1,6 +1,11 @@
 import json
+import time
 import requests
 from OpenSSL import crypto
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
 
 http_code_ok = 200
 # http_code_created = 201
@@ -35,9 +40,11 @@ class CredStoreLibrary(object):
             raise AssertionError("Expected common name was '%s' but was '%s'."
                                  % (expected_data, subject.commonName))
 
-    def add_a_secret(self, name, value):
+    def add_a_secret(self, name, value, cas=None):
         url = 'http://127.0.0.1:5003/v1.0/secrets'
         payload = {'name': name, 'value': value}
+        if cas is not None:
+            payload['cas'] = int(cas)
         res = requests.post(url, json=payload)
         json_data = json.loads(res.text)
         self._status = json_data['code']
@@ -55,20 +62,90 @@ class CredStoreLibrary(object):
         json_data = json.loads(res.text)
         self._status = json_data['code']
 
-    def read_a_secret(self, secretname=None):
+    def read_a_secret(self, secretname=None, version=None):
         url = 'http://127.0.0.1:5003/v1.0/secrets/' + secretname
-        res = requests.get(url)
+        params = {'version': version} if version is not None else None
+        res = requests.get(url, params=params)
         json_data = json.loads(res.text)
         self._status = json_data['code']
         if(self._status == http_code_ok):
             self._data = json_data['secret_value']
 
+    def undelete_a_secret(self, secretname=None):
+        url = 'http://127.0.0.1:5003/v1.0/secrets/' + secretname + ':undelete'
+        res = requests.post(url)
+        json_data = json.loads(res.text)
+        self._status = json_data['code']
+
+    def batch_a_secret_operation(self, operation, *secrets):
+        url = 'http://127.0.0.1:5003/v1.0/secrets:batch'
+        if operation == 'write':
+            secrets = [{'name': name, 'value': value} for name, value in
+                       (secret.split('=', 1) for secret in secrets)]
+        payload = {'operation': operation, 'secrets': list(secrets)}
+        res = requests.post(url, json=payload)
+        json_data = json.loads(res.text)
+        self._status = json_data['code']
+        self._data = ' '.join(str(result['code']) for result in json_data.get('results', []))
+
+    def post_a_json_body(self, path, body):
+        url = 'http://127.0.0.1:5003' + path
+        headers = {'Content-Type': 'application/json'}
+        res = requests.post(url, data=body, headers=headers)
+        self._status = res.status_code
+        self._data = res.text
+
+    def warm_pool_should_be_filling(self, name, timeout=10):
+        url = 'http://127.0.0.1:5003/v1.0/status'
+        deadline = time.monotonic() + float(timeout)
+        while True:
+            pool = requests.get(url).json()['warm_pools'].get(name)
+            if pool is not None and pool['created'] > 0:
+                break
+            if time.monotonic() > deadline:
+                raise AssertionError("Expected pool '%s' to be filling but it was '%s'."
+                                     % (name, pool))
+            time.sleep(0.5)
+        if pool['hits'] + pool['misses'] != 0:
+            raise AssertionError("Expected pool '%s' to be filling before the first request but it was taken from."
+                                 % (name,))
+
     def get_the_certification_authority(self):
         url = 'http://127.0.0.1:5003/v1.0/nodecerts/ca'
         res = requests.get(url)
         self._status = res.status_code
         self._data = res.text
 
+    def _certificate_request(self, cert_common_name):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cert_common_name)])
+        csr = x509.CertificateSigningRequestBuilder().subject_name(name).sign(key, hashes.SHA256())
+        return csr.public_bytes(serialization.Encoding.PEM).decode()
+
+    def sign_a_certificate_request(self, cert_common_name):
+        url = 'http://127.0.0.1:5003/v1.0/nodecerts/sign'
+        headers = {'Content-Type': 'application/pkcs10'}
+        res = requests.post(url, data=self._certificate_request(cert_common_name), headers=headers)
+        self._status = res.status_code
+        self._data = res.text
+
+    def sign_a_malformed_certificate_request(self):
+        url = 'http://127.0.0.1:5003/v1.0/nodecerts/sign'
+        payload = {'csr': '-----BEGIN CERTIFICATE REQUEST-----\nnot a request\n-----END CERTIFICATE REQUEST-----\n'}
+        res = requests.post(url, json=payload)
+        self._status = res.status_code
+        self._data = res.text
+
+    def sign_certificate_requests_in_a_batch(self, cert_common_name, count):
+        url = 'http://127.0.0.1:5003/v1.0/nodecerts/sign'
+        payload = {'csrs': [self._certificate_request(cert_common_name)] * int(count)}
+        res = requests.post(url, json=payload)
+        self._status = res.status_code
+        if res.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+            self._data = ' '.join(str(json.loads(line)['code']) for line in res.text.splitlines() if line)
+        else:
+            self._data = res.text
+
     def create_a_certificate(self, cert_common_name=None):
         url = 'http://127.0.0.1:5003/v1.0/nodecerts'
         if cert_common_name is not "":
@@ -0,0 +1,68 @@
+'''[summary]
+Micro-benchmark of the JSON response path
+[description]
+Times JsonResponse.create for the payloads the API returns (none, a secret, a batch of
+results) with the standard library encoder and with orjson if it is installed, next to
+the former implementation building and encoding the whole body per response.
+
+Run from the repository root:
+python test/bench/json_response.py [--number 20000]
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from flask import Response  # noqa: E402
+from lib import json_response  # noqa: E402
+from lib.json_response import JsonResponse  # noqa: E402
+
+
+PAYLOADS = {
+    'empty': (JsonResponse.DELETE_SECRET_SUCCESS, None),
+    'secret': (JsonResponse.READ_SECRET_SUCCESS, {'secret_value': 'x' * 64}),
+    'batch': (JsonResponse.BATCH_SUCCESS, {'results': [
+        {'name': 'secret%d' % index, 'code': 200, 'message': 'Read secret successful.', 'secret_value': 'x' * 64}
+        for index in range(50)]})
+}
+
+
+def legacy_create(message_label, payload=None):
+    data = {
+        'code': JsonResponse._msg_dict[message_label.value][0],
+        'message': JsonResponse._msg_dict[message_label.value][1]
+    }
+    if payload:
+        data.update(payload)
+
+    return Response(json.dumps(data), status=JsonResponse._msg_dict[message_label.value][0],
+                    mimetype='application/json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=20000, help='responses per measurement')
+    args = parser.parse_args()
+
+    encoders = [('json', json_response._json_dumps)]
+    if json_response.orjson is not None:
+        encoders.append(('orjson', json_response._orjson_dumps))
+
+    print('%-8s %-8s %10s' % ('payload', 'encoder', 'us/call'))
+
+    for name, (message_label, payload) in PAYLOADS.items():
+        elapsed = timeit.timeit(lambda: legacy_create(message_label, payload), number=args.number)
+        print('%-8s %-8s %10.2f' % (name, 'legacy', elapsed / args.number * 1e6))
+
+        for encoder, dumps in encoders:
+            json_response.JSON_RESPONSE_ENCODER = dumps
+
+            elapsed = timeit.timeit(lambda: JsonResponse.create(message_label, payload), number=args.number)
+            print('%-8s %-8s %10.2f' % (name, encoder, elapsed / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
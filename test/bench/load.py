@@ -0,0 +1,304 @@
+'''[summary]
+Load test of SPM against local stand-ins
+[description]
+Starts SPM in-process against the fakes of test/bench/fakes.py (Vault KV and PKI, the
+Kubernetes API, kubeadm, the crypto engine and the image verifier), each answering
+after a fixed latency, and drives concurrent workloads through the WSGI app:
+
++ join: node-join bursts, a join token and a node certificate per node
++ sign: node-join bursts with keys generated on the nodes, a join token and a signed
+  certificate per node, and batches of signing requests
++ secrets: fan-out of reads over many secrets, with some writes
++ crl: CRL polling with If-None-Match, as the nodes do
++ appsecrets: writes and reads of the micado.appsecret object
++ enablers: requests proxied to the crypto engine and the image verifier
+
+Throughput and p50/p99 latency are reported per endpoint. With --save-baseline the
+results are written to a file; with --baseline they are compared to it and the exit
+status is 1 if the p99 latency of an endpoint got worse by more than --tolerance,
+so the script can run in CI.
+
+Run from the repository root:
+python test/bench/load.py [--requests 200] [--concurrency 16] [--latency 0.005] [--workloads join,crl]
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+
+# Number of signing requests in a batch of the sign workload, one request in SIGN_BATCH is a batch
+SIGN_BATCH = 10
+
+# Number of secrets read in the fan-out workload
+SECRETS_FANOUT = 100
+
+# One request in SECRETS_WRITE_EVERY of the fan-out workload is a write
+SECRETS_WRITE_EVERY = 10
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class Recorder:
+    '''[summary]
+    Latencies and errors per endpoint
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.elapsed = {}
+
+    def record(self, endpoint, latency, ok):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(latency)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + (not ok)
+
+    def results(self):
+        results = {}
+
+        for endpoint, samples in self.samples.items():
+            elapsed = self.elapsed[endpoint]
+            results[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors[endpoint],
+                'throughput': len(samples) / elapsed if elapsed else 0.0,
+                'p50': percentile(samples, 0.5),
+                'p99': percentile(samples, 0.99)
+            }
+
+        return results
+
+
+class Client:
+    '''[summary]
+    Calls the WSGI app and records each request under its endpoint
+    '''
+
+    def __init__(self, app, recorder):
+        self._app = app
+        self._recorder = recorder
+        self._local = threading.local()
+
+    def request(self, endpoint, method, path, expected, **kwargs):
+        '''[summary]
+        Send a request, not recorded if endpoint is None
+        '''
+        client = getattr(self._local, 'client', None)
+
+        if client is None:
+            client = self._local.client = self._app.test_client()
+
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        # read and close it like a WSGI server, streamed bodies hold an upstream slot until then
+        response.get_data()
+        response.close()
+        latency = time.perf_counter() - started
+
+        if endpoint is not None:
+            self._recorder.record(endpoint, latency, response.status_code in expected)
+
+        return response
+
+
+def run(recorder, endpoints, concurrency, count, call):
+    '''[summary]
+    Run count calls on concurrency threads, the time is accounted to every endpoint used
+    '''
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(count)))
+
+    for endpoint in endpoints:
+        recorder.elapsed[endpoint] = recorder.elapsed.get(endpoint, 0.0) + time.monotonic() - started
+
+
+def workload_join(client, recorder, concurrency, count):
+    def join(index):
+        client.request('POST /v1.0/jointokens', 'POST', '/v1.0/jointokens', (201,))
+        client.request('POST /v1.0/nodecerts', 'POST', '/v1.0/nodecerts', (200,))
+
+    run(recorder, ('POST /v1.0/jointokens', 'POST /v1.0/nodecerts'), concurrency, count, join)
+
+
+def workload_sign(client, recorder, concurrency, count):
+    batch = {'csrs': [fakes.CSR_PEM] * SIGN_BATCH}
+
+    def join(index):
+        client.request('POST /v1.0/jointokens', 'POST', '/v1.0/jointokens', (201,))
+
+        if index % SIGN_BATCH:
+            client.request('POST /v1.0/nodecerts/sign', 'POST', '/v1.0/nodecerts/sign', (200,),
+                           data=fakes.CSR_PEM, content_type='application/pkcs10')
+        else:
+            client.request('POST /v1.0/nodecerts/sign batch', 'POST', '/v1.0/nodecerts/sign', (200,), json=batch)
+
+    run(recorder, ('POST /v1.0/jointokens', 'POST /v1.0/nodecerts/sign', 'POST /v1.0/nodecerts/sign batch'),
+        concurrency, count, join)
+
+
+def workload_secrets(client, recorder, concurrency, count):
+    for index in range(SECRETS_FANOUT):
+        client.request(None, 'POST', '/v1.0/secrets', (201,), json={'name': 'fanout%d' % index, 'value': 'x' * 64})
+
+    def fanout(index):
+        name = 'fanout%d' % (index % SECRETS_FANOUT)
+
+        if index % SECRETS_WRITE_EVERY == 0:
+            client.request('PUT /v1.0/secrets/<name>', 'PUT', '/v1.0/secrets/' + name, (200, 201),
+                           json={'value': 'y' * 64})
+        else:
+            client.request('GET /v1.0/secrets/<name>', 'GET', '/v1.0/secrets/' + name, (200,))
+
+    run(recorder, ('GET /v1.0/secrets/<name>', 'PUT /v1.0/secrets/<name>'), concurrency, count, fanout)
+
+
+def workload_crl(client, recorder, concurrency, count):
+    etag = client.request(None, 'GET', '/v1.0/nodecrl', (200,)).headers.get('ETag')
+
+    def poll(index):
+        # most nodes already have the current CRL
+        headers = {'If-None-Match': etag} if index % 4 else {}
+        client.request('GET /v1.0/nodecrl', 'GET', '/v1.0/nodecrl', (200, 304), headers=headers)
+
+    run(recorder, ('GET /v1.0/nodecrl',), concurrency, count, poll)
+
+
+def workload_appsecrets(client, recorder, concurrency, count):
+    def appsecret(index):
+        name = 'app%d' % (index % SECRETS_FANOUT)
+
+        client.request('POST /v1.0/appsecrets', 'POST', '/v1.0/appsecrets', (201, 400),
+                       json={'name': name, 'value': 'z' * 32})
+        client.request('GET /v1.0/appsecrets/<name>', 'GET', '/v1.0/appsecrets/' + name, (200,))
+
+    run(recorder, ('POST /v1.0/appsecrets', 'GET /v1.0/appsecrets/<name>'), concurrency, count, appsecret)
+
+
+def workload_enablers(client, recorder, concurrency, count):
+    payload = os.urandom(4096)
+
+    def enabler(index):
+        if index % 2:
+            client.request('POST /v1.0/cryptoengine/<path>', 'POST', '/v1.0/cryptoengine/encrypt', (200,),
+                           data=payload, content_type='application/octet-stream')
+        else:
+            client.request('POST /v1.0/imageverify', 'POST', '/v1.0/imageverify', (200,),
+                           data=payload, content_type='application/octet-stream')
+
+    run(recorder, ('POST /v1.0/cryptoengine/<path>', 'POST /v1.0/imageverify'), concurrency, count, enabler)
+
+
+WORKLOADS = {
+    'join': workload_join,
+    'sign': workload_sign,
+    'secrets': workload_secrets,
+    'crl': workload_crl,
+    'appsecrets': workload_appsecrets,
+    'enablers': workload_enablers
+}
+
+
+def report(results):
+    print('%-34s %8s %7s %9s %9s %9s' % ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+
+    for endpoint, result in sorted(results.items()):
+        print('%-34s %8d %7d %9.1f %9.2f %9.2f' % (
+            endpoint, result['requests'], result['errors'], result['throughput'],
+            result['p50'] * 1000, result['p99'] * 1000))
+
+
+def compare(results, baseline, tolerance):
+    '''[summary]
+    Compare the results to a baseline
+    [description]
+    Returns:
+        [type] list -- [description] endpoints whose p99 latency regressed by more than tolerance, or that failed
+    '''
+    regressions = []
+
+    for endpoint, result in sorted(results.items()):
+        if result['errors']:
+            regressions.append('%s: %d errors' % (endpoint, result['errors']))
+            continue
+
+        if endpoint not in baseline:
+            continue
+
+        limit = baseline[endpoint]['p99'] * (1 + tolerance)
+
+        if result['p99'] > limit:
+            regressions.append('%s: p99 %.2fms, baseline %.2fms' % (
+                endpoint, result['p99'] * 1000, baseline[endpoint]['p99'] * 1000))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=200, help='iterations per workload')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds each stand-in takes to answer')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='comma separated, of ' + ', '.join(WORKLOADS))
+    parser.add_argument('--join-token-mode', default='native', choices=('native', 'kubeadm'))
+    parser.add_argument('--kv-version', type=int, default=1, choices=(1, 2))
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the results to FILE')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed p99 regression, 0.5 is 50%%')
+    args = parser.parse_args()
+
+    logging.getLogger('flask.app').setLevel(logging.WARNING)
+
+    fakes.install(args.latency, args.join_token_mode, args.kv_version)
+
+    from lib.startup import warm_up
+    from app import app
+
+    if not warm_up():
+        sys.exit('Unable to initialize the backends.')
+
+    recorder = Recorder()
+    client = Client(app, recorder)
+
+    for name in args.workloads.split(','):
+        WORKLOADS[name](client, recorder, args.concurrency, args.requests)
+
+    results = recorder.results()
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''[summary]
+Sync vs threaded serving benchmark
+[description]
+Sends the same burst of GET /v1.0/secrets/<name> requests through the WSGI app with as
+many requests in flight as the serving modes allow: sync gunicorn workers (one request
+each), the same number of gthread workers with --threads threads each, and as many sync
+workers as that gives threads, for a comparison at equal concurrency. Vault is replaced
+by a stub that answers after a fixed latency, so the numbers show how throughput follows
+the number of backend calls in flight, whichever mode provides it.
+
+Run from the repository root:
+python test/bench/serving.py [--requests 500] [--workers 4] [--threads 8] [--latency 0.05] [--no-baseline]
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from werkzeug.test import EnvironBuilder  # noqa: E402
+from lib.vault_backend import VaultBackend  # noqa: E402
+
+
+class SlowVault:
+    def __init__(self, latency):
+        self._latency = latency
+
+    def read_secret(self, name):
+        time.sleep(self._latency)
+        return {'data': {'secret_value': 'value-of-' + name}}
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def report(mode, concurrency, started, latencies):
+    elapsed = time.monotonic() - started
+    print('%-22s %4d in flight %6d requests in %6.2fs  %8.1f req/s  p50 %6.1fms  p99 %6.1fms' % (
+        mode, concurrency, len(latencies), elapsed, len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+
+def run(wsgi_app, mode, count, concurrency):
+    def call(index):
+        started = time.monotonic()
+        environ = EnvironBuilder(path='/v1.0/secrets/secret%d' % index).get_environ()
+        body = b''.join(wsgi_app(environ, lambda status, headers, exc_info=None: None))
+        assert b'value-of-' in body
+        return time.monotonic() - started
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, range(count)))
+    report(mode, concurrency, started, latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4, help='number of gunicorn workers')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gthread worker')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds Vault takes to answer')
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='skip the sync workers without threads, slow with many requests')
+    args = parser.parse_args()
+
+    # skip the Vault initialization and answer reads from the stub
+    VaultBackend._initialized = True
+    VaultBackend.read_secret = SlowVault(args.latency).read_secret
+
+    from app import app
+
+    concurrency = args.workers * args.threads
+
+    if not args.no_baseline:
+        run(app, 'sync x%d' % args.workers, args.requests, args.workers)
+
+    run(app, 'gthread x%d x%d' % (args.workers, args.threads), args.requests, concurrency)
+    run(app, 'sync x%d' % concurrency, args.requests, concurrency)
+
+
+if __name__ == '__main__':
+    main()